@@ -1,8 +1,15 @@
 import boto
 import itertools as itt
 import instances as inst
+import logging
+import threading
+import waiter as wt
 import ConfigParser as cprs
 
+from boto.route53.record import ResourceRecordSets
+
+log = logging.getLogger("adns")
+
 config = cprs.SafeConfigParser()
 config.read("aint.ini")
 
@@ -13,8 +20,49 @@ zone_id = config.get("adns", "zone_id")
 def current_rrs(r53, zone_id=zone_id):
     return r53.get_all_rrsets(zone_id)
 
+# Route53 rejects change batches with more changes than this.
+max_changes = 100
+
+def rr_name(rrname):
+    """Normalizes a record name the way Route53 returns it."""
+
+    return rrname.rstrip(".").lower() + "."
+
+def rr_values(rrtype, rrvalues):
+    """Normalizes record values so equal targets compare equal."""
+
+    if rrtype == "CNAME":
+        return sorted(rr_name(v) for v in rrvalues)
+
+    return sorted(rrvalues)
+
+def index_rrs(rrs):
+    """Returns the records in `rrs` keyed by (name, type) and by
+    (name, None). The index is built once and cached on `rrs`."""
+
+    index = getattr(rrs, "_rr_index", None)
+    if index is None:
+        index = {}
+        for r in rrs:
+            index.setdefault((rr_name(r.name), r.type), []).append(r)
+            index.setdefault((rr_name(r.name), None), []).append(r)
+        rrs._rr_index = index
+
+    return index
+
 def get_rrs(rrs, rrname, rrtype=None):
-    return (r for r in rrs if r.name==rrname and (r.type==rrtype if rrtype is not None else True))
+    return iter(index_rrs(rrs).get((rr_name(rrname), rrtype), ()))
+
+def rr_matches(rrs, rrname, rrtype, rrvalues, rrttl=300):
+    """Returns `True` if `rrs` already holds exactly this record."""
+
+    cur_rrs = list(get_rrs(rrs, rrname, rrtype))
+    if len(cur_rrs) != 1:
+        return False
+
+    cur_rr = cur_rrs[0]
+    return (int(cur_rr.ttl) == int(rrttl) and
+            rr_values(rrtype, cur_rr.resource_records) == rr_values(rrtype, rrvalues))
 
 def create_rr(rrs, rrname, rrtype, rrvalues, rrttl=300):
     rr = rrs.add_change("CREATE", rrname, rrtype, rrttl)
@@ -28,14 +76,170 @@ def delete_rr(rrs, rrname, rrtype):
         [rr.add_value(value) for value in cur_rr.resource_records]
 
 def replace_rr(rrs, rrname, rrtype, rrvalues, rrttl=300):
+    """Queues a DELETE+CREATE for the record, unless it is already
+    current. Returns `True` if changes were queued."""
+
+    if rr_matches(rrs, rrname, rrtype, rrvalues, rrttl):
+        return False
+
     delete_rr(rrs, rrname, rrtype)
     create_rr(rrs, rrname, rrtype, rrvalues, rrttl)
+    return True
+
+class ZoneSync(object):
+    """Collects the records a zone should hold and commits only the
+    changes needed to get there.
+
+    Call `want` for each record, then `commit`. Records that are already
+    current end up in `unchanged`."""
+
+    def __init__(self, r53, rrs=None, zone_id=zone_id):
+        self.r53 = r53
+        self.zone_id = zone_id
+        self.rrs = rrs if rrs is not None else current_rrs(r53, zone_id)
+        self.wanted = []
+        self.unchanged = []
+
+    def want(self, rrname, rrtype, rrvalues, rrttl=300):
+        self.wanted.append((rr_name(rrname), rrtype, list(rrvalues), rrttl))
+
+    def changes(self):
+        """Returns the changes to make, one list per record, each a list
+        of (action, name, type, ttl, values) tuples."""
+
+        changes = []
+        self.unchanged = []
+        for rrname, rrtype, rrvalues, rrttl in self.wanted:
+            if rr_matches(self.rrs, rrname, rrtype, rrvalues, rrttl):
+                self.unchanged.append(rrname)
+                continue
+
+            record = [("DELETE", cur_rr.name, cur_rr.type, cur_rr.ttl, cur_rr.resource_records)
+                      for cur_rr in get_rrs(self.rrs, rrname, rrtype)]
+            record.append(("CREATE", rrname, rrtype, rrttl, rrvalues))
+            changes.append(record)
+
+        return changes
+
+    def batches(self):
+        """Groups the changes into batches Route53 will accept, keeping
+        each record's DELETE and CREATE in the same batch."""
+
+        batch = []
+        for record in self.changes():
+            if batch and len(batch) + len(record) > max_changes:
+                yield batch
+                batch = []
+            batch.extend(record)
+
+        if batch:
+            yield batch
+
+    def commit(self):
+        """Commits the changes and returns the commit responses, one
+        per batch."""
+
+        results = []
+        for batch in self.batches():
+            rrs = ResourceRecordSets(self.r53, self.zone_id)
+            for action, rrname, rrtype, rrttl, rrvalues in batch:
+                rr = rrs.add_change(action, rrname, rrtype, rrttl)
+                [rr.add_value(value) for value in rrvalues]
+            results.append(rrs.commit())
+
+        return results
+
+def change_id(response):
+    """Returns the change id from a ResourceRecordSets.commit() response."""
+
+    return str(response["ChangeResourceRecordSetsResponse"]["ChangeInfo"]["Id"]).split("/")[-1]
+
+class ChangeTracker(object):
+    """Follows committed changes until Route53 reports them INSYNC.
+
+    `track` the commit responses, `start` to poll them in the
+    background, and `wait` at the point where the names actually need
+    to resolve. Launch threads may track and start changes at the same
+    time; the lists and set of changes are guarded by a lock, which
+    isn't held while Route53 is asked."""
+
+    def __init__(self, r53, timeout=None):
+        self.r53 = r53
+        self.timeout = timeout
+        self.change_ids = []
+        self.insync = set()
+        self._untracked = []
+        self._waiters = []
+        self._lock = threading.Lock()
+
+    def track(self, responses):
+        """Records the change ids of commit `responses` (one response or a list)."""
+
+        if isinstance(responses, dict):
+            responses = [responses]
+
+        ids = [change_id(r) for r in responses]
+        with self._lock:
+            self.change_ids.extend(ids)
+            self._untracked.extend(ids)
+
+        return ids
+
+    def is_insync(self, cid):
+        with self._lock:
+            return cid in self.insync
+
+    def poll(self, ids):
+        for cid in ids:
+            if self.is_insync(cid):
+                continue
+
+            status = self.r53.get_change(cid)["GetChangeResponse"]["ChangeInfo"]["Status"]
+            if status == "INSYNC":
+                with self._lock:
+                    self.insync.add(cid)
+
+    def pending(self):
+        with self._lock:
+            return [cid for cid in self.change_ids if cid not in self.insync]
+
+    def start(self):
+        """Starts polling the changes tracked so far in a background thread."""
+
+        with self._lock:
+            ids, self._untracked = self._untracked, []
+        if not ids:
+            return
+
+        waiter = wt.Waiter(base=1, cap=10)
+        waiter.add_hook(lambda: self.poll(ids))
+        for cid in ids:
+            waiter.add(lambda cid=cid: self.is_insync(cid), timeout=self.timeout, name="change %s" % cid)
+
+        waiter.start()
+        with self._lock:
+            self._waiters.append(waiter)
+
+    def wait(self):
+        """Blocks until every tracked change is INSYNC."""
+
+        self.start()
+
+        if self.pending():
+            log.info("Waiting for DNS changes to propagate: %s", ", ".join(self.pending()))
+
+        with self._lock:
+            waiters = list(self._waiters)
+        for waiter in waiters:
+            waiter.join()
+
+        log.info("DNS changes in sync")
 
 def connect():
     return boto.connect_route53()
 
-def sync_instance(rrs, instance):
+def sync_instance(zone, instance):
     """Syncs the DNS CNAME of the instance to the instance. commit()
-    must be called on rrs afterwards."""
+    must be called on the `ZoneSync` zone afterwards."""
 
-    replace_rr(rrs, inst.hostname(instance), "CNAME", [inst.aws_hostname(inst)])
+    zone.want(inst.hostname(instance), "CNAME", [inst.aws_hostname(instance)])
@@ -0,0 +1,64 @@
+"""Registry of baked machine images.
+
+bake_ami records each image it bakes here, under the host type and the
+hash of the provisioning bundle it was configured with, and
+start_instance launches from the image matching the current bundle
+when there is one. An image baked from an older bundle is never used:
+its journal would skip steps whose code has since changed."""
+
+import json
+import logging
+import os
+import os.path as opath
+import tempfile as tempf
+import time
+
+log = logging.getLogger("amis")
+
+default_path = opath.expanduser("~/.aint/amis.json")
+
+class Registry(object):
+    """Baked images by host type, then config hash."""
+
+    def __init__(self, path=default_path):
+        self.path = path
+        self.images = {}
+
+        if opath.exists(path):
+            with open(path) as registry_in:
+                self.images = json.load(registry_in)
+
+    def record(self, host_type, config_hash, ami, base_ami, instance_type, steps):
+        """Records image `ami`, baked from `base_ami` on `instance_type`
+        with `steps` done, replacing any image for the same host type
+        and config hash."""
+
+        entries = self.images.setdefault(host_type, {})
+        old = entries.get(config_hash)
+        if old is not None:
+            log.info("Replacing %s image %s; deregister it if nothing uses it", host_type, old["ami"])
+
+        entries[config_hash] = {"ami": ami, "base_ami": base_ami, "instance_type": instance_type,
+                                "steps": list(steps), "created": time.time()}
+        self.save()
+
+    def newest(self, host_type, config_hash, base_ami=None):
+        """Returns the entry for the image baked for `host_type` from
+        `config_hash` (and `base_ami`, if given), or None."""
+
+        entry = self.images.get(host_type, {}).get(config_hash)
+        if entry is None or (base_ami is not None and entry["base_ami"] != base_ami):
+            return None
+
+        return entry
+
+    def save(self):
+        dir_name = opath.dirname(self.path)
+        if not opath.isdir(dir_name):
+            os.makedirs(dir_name)
+
+        fd, tmp_path = tempf.mkstemp(dir=dir_name)
+        with os.fdopen(fd, "w") as registry_out:
+            json.dump(self.images, registry_out, indent=1, sort_keys=True)
+
+        os.rename(tmp_path, self.path)
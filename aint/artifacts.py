@@ -0,0 +1,92 @@
+"""Cache of built artifacts, such as the MySQL binaries.
+
+An artifact is stored under its name and a key derived from whatever
+determines its contents (version, architecture, build flags), next to a
+file holding its SHA-256. Hosts share the cache through the control
+box: start_instance pushes it to each host before setup and pulls back
+anything the host built. When it launches several hosts from the stock
+image, it configures the first one on its own before the rest, so each
+artifact is built once rather than by every host at the same time."""
+
+import hashlib
+import json
+import logging
+import os
+import os.path as opath
+import platform
+import shutil
+import tempfile as tempf
+
+log = logging.getLogger("artifacts")
+
+# The cache on the control box, and where it is copied to on hosts.
+local_dir = opath.expanduser("~/.aint/artifacts")
+remote_dir = "setup_ec2/artifacts"
+
+def artifact_key(**params):
+    """Returns a key for an artifact built with `params`. The machine
+    architecture is always part of the key."""
+
+    params.setdefault("arch", platform.machine())
+
+    return hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()[:16]
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f_in:
+        for chunk in iter(lambda: f_in.read(1 << 20), ""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+class ArtifactCache(object):
+    """Artifacts under `root`, as `<name>-<key>.tar.gz` plus a
+    `.sha256` file."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, name, key):
+        return opath.join(self.root, "%s-%s.tar.gz" % (name, key))
+
+    def get(self, name, key):
+        """Returns the path of the artifact, or None if it isn't cached
+        or fails its checksum. A corrupt artifact is removed."""
+
+        path = self.path(name, key)
+        if not opath.exists(path) or not opath.exists(path + ".sha256"):
+            return None
+
+        with open(path + ".sha256") as sum_in:
+            expected = sum_in.read().strip()
+
+        if file_sha256(path) != expected:
+            log.warning("Checksum mismatch for %s; discarding it", path)
+            os.remove(path)
+            os.remove(path + ".sha256")
+            return None
+
+        return path
+
+    def put(self, name, key, src_path):
+        """Moves the file at `src_path` into the cache and returns its new path."""
+
+        if not opath.isdir(self.root):
+            os.makedirs(self.root)
+
+        path = self.path(name, key)
+        sha256 = file_sha256(src_path)
+
+        fd, tmp_path = tempf.mkstemp(dir=self.root)
+        with os.fdopen(fd, "w") as sum_out:
+            sum_out.write(sha256 + "\n")
+
+        # Other users on the host (memrise) install from the cache too.
+        os.chmod(src_path, 0644)
+        os.chmod(tmp_path, 0644)
+
+        shutil.move(src_path, path)
+        os.rename(tmp_path, path + ".sha256")
+        log.info("Cached %s (sha256 %s)", path, sha256)
+
+        return path
@@ -0,0 +1,97 @@
+"""Bakes a machine image for a host type.
+
+A builder instance is started from the stock image, configured with
+the host type's setup_ec2 steps except the per-host ones
+(setup_ec2.per_host_steps), and imaged. The image is recorded in the
+amis registry under the bundle hash, and start_instance launches new
+hosts of that type from it. The image keeps the builder's setup
+journal, so on a new host setup_ec2 only runs the per-host steps."""
+
+import argparse
+import json
+import logging
+import subprocess as subp
+import time
+
+import boto
+import boto.exception
+
+import amis
+import bundle
+import start_instance as si
+import waiter as wt
+
+log = logging.getLogger("bake_ami")
+
+def baked_steps(session):
+    """Returns the steps recorded in the journal on the builder."""
+
+    journal = subp.check_output(session.command("cat .aint/journal.json", port=2000))
+    return sorted(json.loads(journal))
+
+def wait_for_image(ec2, image_id, timeout=3600):
+    def available():
+        # A new image can take a while to show up in DescribeImages.
+        try:
+            image = ec2.get_image(image_id)
+        except boto.exception.EC2ResponseError, e:
+            if e.error_code != "InvalidAMIID.NotFound":
+                raise
+            image = None
+
+        if image is None:
+            return False
+        if image.state == "failed":
+            raise Exception("Image %s failed" % image_id)
+        return image.state == "available"
+
+    log.info("Waiting for image %s to become available", image_id)
+    wt.wait(available, timeout=timeout, base=10, cap=60)
+
+def bake(ec2, host_type, keep_builder=False):
+    """Bakes and registers an image for `host_type`; returns its id."""
+
+    instance_type = si.server_types[host_type][0]
+    base_ami = si.instance_ami_map[instance_type]
+    config_hash = bundle.build().hash
+
+    builder = si.start_instances(ec2, instance_type)[0]
+    builder.add_tag("Name", "bake-%s" % host_type)
+    try:
+        si.remove_stale_host_keys([builder])
+
+        waiter = wt.Waiter()
+        si.wait_for_ssh([builder], waiter, lambda instance: None)
+        waiter.run()
+
+        si.provision(builder, "bake-%s" % host_type, host_type, "--bake")
+        steps = baked_steps(si.session(builder))
+        si.session(builder).close()
+
+        name = "aint-%s-%s-%d" % (host_type, config_hash[:12], time.time())
+        log.info("Creating image %s from %s", name, builder.id)
+        image_id = ec2.create_image(builder.id, name,
+                                    description="%s baked from bundle %s" % (host_type, config_hash))
+        wait_for_image(ec2, image_id)
+    finally:
+        if keep_builder:
+            log.info("Leaving builder %s running", builder.id)
+        else:
+            log.info("Terminating builder %s", builder.id)
+            ec2.terminate_instances([builder.id])
+
+    amis.Registry().record(host_type, config_hash, image_id, base_ami, instance_type, steps)
+    log.info("Baked %s image %s (bundle %s) with steps: %s", host_type, image_id, config_hash, ", ".join(steps))
+
+    return image_id
+
+def main():
+    parser = argparse.ArgumentParser(description="Bake and register a machine image for a host type.")
+    parser.add_argument("host_type", choices=sorted(si.server_types))
+    parser.add_argument("--keep-builder", action="store_true", help="don't terminate the builder instance")
+    args = parser.parse_args()
+
+    print bake(boto.connect_ec2(), args.host_type, args.keep_builder)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Provisioning bundle: the aint scripts and resources in one archive.
+
+The archive is named after a hash of its contents and cached locally,
+so a launch packs it at most once however many hosts it configures. It
+is streamed to each host over a single ssh command, which skips the
+transfer if the host already has that hash."""
+
+import hashlib
+import logging
+import os
+import os.path as opath
+import shutil
+import subprocess as subp
+import tarfile
+import tempfile as tempf
+import threading
+
+log = logging.getLogger("bundle")
+
+package_dir = opath.dirname(opath.abspath(__file__))
+
+# Where built bundles are kept on the control box.
+cache_dir = opath.expanduser("~/.aint/bundles")
+
+# The scripts are run on the host from setup_ec2/aws (see start_instance).
+remote_dir = "setup_ec2"
+remote_package = "aws"
+
+skip_suffixes = (".pyc", ".pyo", "~")
+
+def bundle_files(root=package_dir):
+    """Returns the paths under `root` that go into the bundle, sorted."""
+
+    paths = []
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names[:] = sorted(d for d in dir_names if not d.startswith("."))
+        for file_name in sorted(file_names):
+            if file_name.startswith(".") or file_name.endswith(skip_suffixes):
+                continue
+            paths.append(opath.relpath(opath.join(dir_path, file_name), root))
+
+    return paths
+
+def content_hash(paths, root=package_dir):
+    """Returns the SHA-1 of the names and contents of `paths`."""
+
+    digest = hashlib.sha1()
+    for path in paths:
+        digest.update(path + "\0")
+        with open(opath.join(root, path), "rb") as f_in:
+            digest.update(hashlib.sha1(f_in.read()).digest())
+
+    return digest.hexdigest()
+
+class Bundle(object):
+    def __init__(self, hash, path):
+        self.hash = hash
+        self.path = path
+
+_built = None
+_build_lock = threading.Lock()
+def build(root=package_dir):
+    """Returns the `Bundle` for the current tree, packing it only if no
+    bundle with the same hash is cached."""
+
+    global _built
+
+    with _build_lock:
+        if _built is not None:
+            return _built
+
+        paths = bundle_files(root)
+        hash = content_hash(paths, root)
+        path = opath.join(cache_dir, "%s.tar.gz" % hash)
+
+        if not opath.exists(path):
+            log.info("Packing provisioning bundle %s", hash)
+            if not opath.isdir(cache_dir):
+                os.makedirs(cache_dir)
+
+            fd, tmp_path = tempf.mkstemp(dir=cache_dir)
+            with os.fdopen(fd, "wb") as tar_out:
+                tar = tarfile.open(fileobj=tar_out, mode="w:gz")
+                for p in paths:
+                    tar.add(opath.join(root, p), arcname=opath.join(remote_package, p))
+                tar.close()
+
+            os.rename(tmp_path, path)
+
+        _built = Bundle(hash, path)
+        return _built
+
+ship_script = """
+if [ "$(cat %(dir)s/.bundle 2>/dev/null)" = %(hash)s ]; then
+    echo have
+else
+    echo need
+    mkdir -p %(dir)s/.bundles &&
+    cat > %(dir)s/.bundles/%(hash)s.tar.gz &&
+    tar xzf %(dir)s/.bundles/%(hash)s.tar.gz -C %(dir)s &&
+    echo %(hash)s > %(dir)s/.bundle
+fi
+"""
+
+def ship(session, bundle):
+    """Unpacks `bundle` into setup_ec2 on the host behind `session`
+    (a `remote.Session`), unless the host already has it."""
+
+    script = ship_script % {"dir": remote_dir, "hash": bundle.hash}
+    proc = subp.Popen(session.command(script), stdin=subp.PIPE, stdout=subp.PIPE)
+
+    answer = proc.stdout.readline().strip()
+    if answer == "need":
+        log.info("Sending bundle %s to %s", bundle.hash, session.host)
+        with open(bundle.path, "rb") as bundle_in:
+            shutil.copyfileobj(bundle_in, proc.stdin)
+    else:
+        log.info("%s already has bundle %s", session.host, bundle.hash)
+
+    proc.stdin.close()
+    proc.stdout.read()
+
+    status = proc.wait()
+    if status:
+        raise subp.CalledProcessError(status, "ship bundle %s to %s" % (bundle.hash, session.host))
@@ -2,8 +2,29 @@
 
 import instances as aint
 import adns as sdns
+import fanout
+import remote
+import settings
+import snapshot
 
 import boto
+import os.path as opath
+
+_ec2 = None
+def ec2():
+    """Returns the EC2 connection shared by all commands."""
+
+    global _ec2
+
+    if _ec2 is None:
+        _ec2 = aint.connect()
+
+    return _ec2
+
+def instances():
+    """Returns the shared instance inventory."""
+
+    return aint.inventory(ec2())
 
 def start_spare_web_servers(count=4):
     """Start `count` spare web servers if we have that many stopped.
@@ -14,7 +35,7 @@ def start_spare_web_servers(count=4):
 
     count = int(count)
 
-    srvrs = [i for i in instances() if aint.is_web(i) and aint.is_stopped(i)][:count]
+    srvrs = instances().of_type("web", "stopped")[:count]
 
     if not srvrs:
         print("WARNING: No spare web servers.")
@@ -23,30 +44,53 @@ def start_spare_web_servers(count=4):
     print("Starting servers:")
     print("    " + ", ".join((aint.name(srvr) for srvr in srvrs)))
 
-    for srvr in srvrs:
-        srvr.start()
+    instances().start(srvrs)
+    snapshot.invalidate()
 
     print("Waiting for servers to start.")
-    rc.wait(lambda: aint.all_running(ec2(), srvrs))
+    aint.wait_for_state(ec2(), srvrs, "running")
 
     print("Updating DNS.")
     r53 = sdns.connect()
-    rrs = sdns.current_rrs(r53)
+    zone = sdns.ZoneSync(r53)
 
-    [sdns.replace_rr(rrs, aint.memrise_hostname(srvr) + ".", "CNAME", [aint.aws_hostname(srvr) + "."])
+    [zone.want(aint.hostname(srvr) + ".", "CNAME", [aint.aws_hostname(srvr) + "."])
      for srvr in srvrs]
 
-    rrs.commit()
+    dns = sdns.ChangeTracker(r53)
+    dns.track(zone.commit())
+    dns.wait()
 
     print("WARNING: Started %d web servers. Please run deploy." % (len(srvrs)))
     print("Servers:")
     for srvr in srvrs:
         print("\t" + aint.name(srvr))
 
+def run_on_servers(cmd, instance_type="web", limit=8, log_dir=None):
+    """Runs `cmd` on every running server of `instance_type` at once,
+    e.g. fab run_on_servers:"touch memrise/memrise/wsgi.py".
+
+    Output is streamed prefixed with each host name, and written to one
+    file per host in `log_dir` if given. The servers come from the
+    inventory snapshot, rather than a sweep of the account."""
+
+    srvrs = [r for r in snapshot.records() if aint.is_type(r, instance_type) and aint.is_running(r)]
+    sessions = [remote.Session(aint.aws_hostname(srvr), key_path=opath.expanduser(settings.ssh_key_path), port=2000)
+                for srvr in srvrs]
+
+    try:
+        results = fanout.run_all(sessions, cmd, limit=int(limit), log_dir=log_dir)
+    finally:
+        [s.close() for s in sessions]
+
+    failed = [r.host for r in results if not r.ok]
+    if failed:
+        raise Exception("Command failed on: %s" % ", ".join(failed))
+
 def load_balance_web_servers():
     """Syncs running and stopped web servers with the load balancer."""
 
-    srvrs = [i for i in instances() if aint.is_running(i) and aint.is_web(i)]
+    srvrs = instances().of_type("web", "running")
 
     elb_conn = boto.connect_elb()
     elb = [e for e in elb_conn.get_all_load_balancers() if e.name == u"Cave"][0]
@@ -68,11 +112,9 @@ def load_balance_web_servers():
 def stop_spare_web_servers(count=4):
     """Stop `count` web servers. Will always keep 4 running."""
 
-    global _instances
-
     count = int(count)
 
-    srvrs = [i for i in instances() if aint.is_web(i) and aint.is_running(i)]
+    srvrs = instances().of_type("web", "running")
     stop_srvrs = srvrs[-count:]
 
     if len(srvrs) - len(stop_srvrs) < 4:
@@ -82,13 +124,11 @@ def stop_spare_web_servers(count=4):
     print("Stopping servers:")
     print("    " + ", ".join((aint.name(srvr) for srvr in stop_srvrs)))
 
-    for srvr in stop_srvrs:
-        srvr.stop()
+    instances().stop(stop_srvrs)
+    snapshot.invalidate()
 
-    rc.wait(lambda: aint.all_stopped(ec2(), stop_srvrs))
+    aint.wait_for_state(ec2(), stop_srvrs, "stopped")
 
-    # Dump the instances cache so that load_balance_web_servers gets fresh information.
-    _instances = None
     load_balance_web_servers()
 
     local("./fab touch_wsgi")
@@ -0,0 +1,89 @@
+"""EBS volume sets for database hosts.
+
+Volumes are requested as soon as their instance is, so EC2 creates them
+while the instance boots, and each is attached as soon as both it and
+the instance are ready."""
+
+import logging
+
+import waiter as wt
+
+log = logging.getLogger("ebs")
+
+class VolumeError(wt.ConditionFailed):
+    """Raised when EC2 reports a volume in the error state."""
+
+def device_names(count, first="h"):
+    """Returns the device names volumes are attached as: /dev/sdh onwards."""
+
+    return ["/dev/sd%s" % chr(ord(first) + i) for i in xrange(count)]
+
+def refresh(ec2, volumes):
+    """Updates `volumes` in place with a single DescribeVolumes call."""
+
+    by_id = dict((v.id, v) for v in volumes)
+    if not by_id:
+        return
+
+    for fresh in ec2.get_all_volumes(volume_ids=by_id.keys()):
+        if fresh.id in by_id:
+            by_id[fresh.id]._update(fresh)
+
+class VolumeSet(object):
+    """`count` volumes of `size` GB for one instance.
+
+    Creating the set requests every volume at once. `attach_when_ready`
+    adds conditions to a waiter that attach each volume once it is
+    available and the instance is running, and `wait_attached` blocks
+    until EC2 reports every volume attached."""
+
+    def __init__(self, ec2, count, size, zone):
+        self.ec2 = ec2
+        self.volumes = [ec2.create_volume(size, zone) for i in xrange(count)]
+        self.devices = device_names(count)
+        self.attach_requested = set()
+
+        log.info("Requested volumes %s", ", ".join(v.id for v in self.volumes))
+
+    def attach(self, instance, volume, device):
+        log.info("Attaching %s to %s as %s", volume.id, instance.id, device)
+        self.ec2.attach_volume(volume.id, instance.id, device)
+        self.attach_requested.add(volume.id)
+
+    def attach_when_ready(self, instance, waiter, timeout=600):
+        """Adds conditions to `waiter` that attach each volume to
+        `instance` as soon as both are ready. A volume that isn't ready
+        within `timeout` seconds times out, and one that goes into the
+        error state raises `VolumeError`."""
+
+        waiter.add_hook(lambda: refresh(self.ec2, [v for v in self.volumes if v.status != "available"
+                                                   and v.id not in self.attach_requested]))
+
+        def ready(vol):
+            if vol.status == "error":
+                raise VolumeError("Volume %s for %s failed" % (vol.id, instance.id))
+            return vol.status == "available" and instance.state == "running"
+
+        for vol, device in zip(self.volumes, self.devices):
+            waiter.add(lambda vol=vol: ready(vol),
+                       on_met=lambda vol=vol, device=device: self.attach(instance, vol, device),
+                       timeout=timeout,
+                       name="%s available" % vol.id)
+
+    def wait_attached(self, timeout=600):
+        """Blocks until every volume in the set is attached."""
+
+        waiter = wt.Waiter()
+        waiter.add_hook(lambda: refresh(self.ec2, [v for v in self.volumes if v.attachment_state() != "attached"]))
+
+        def attached(vol):
+            if vol.status == "error":
+                raise VolumeError("Volume %s failed" % vol.id)
+            return vol.attachment_state() == "attached"
+
+        for vol in self.volumes:
+            waiter.add(lambda vol=vol: attached(vol),
+                       timeout=timeout,
+                       name="%s attached" % vol.id)
+
+        waiter.run()
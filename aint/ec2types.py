@@ -0,0 +1,23 @@
+"""The EC2 instance types we launch.
+
+start_instance picks the stock image for a type by its word size, and
+mycnf sizes MySQL by its memory and vCPUs. This module doesn't need
+boto, so setup_ec2 can use it on the hosts."""
+
+class InstanceType(object):
+    def __init__(self, memory_gb, vcpus, bits):
+        self.memory_gb = memory_gb
+        self.vcpus = vcpus
+        self.bits = bits
+
+types = {
+    "t1.micro": InstanceType(0.613, 1, 64),
+    "m1.small": InstanceType(1.7, 1, 32),
+    "c1.medium": InstanceType(1.7, 2, 32),
+    "m1.large": InstanceType(7.5, 2, 64),
+    "m1.xlarge": InstanceType(15, 4, 64),
+    "c1.xlarge": InstanceType(7, 8, 64),
+    "m2.xlarge": InstanceType(17.1, 2, 64),
+    "m2.2xlarge": InstanceType(34.2, 4, 64),
+    "m2.4xlarge": InstanceType(68.4, 8, 64),
+    }
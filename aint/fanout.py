@@ -0,0 +1,97 @@
+"""Runs a command on many hosts at once.
+
+Each host's stdout and stderr are streamed as they arrive, prefixed
+with the host name, and optionally written to one log file per host."""
+
+import logging
+import os
+import os.path as opath
+import subprocess as subp
+import sys
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+import remote
+
+log = logging.getLogger("fanout")
+
+class HostResult(object):
+    """Exit status and timing of a command on one host."""
+
+    def __init__(self, host, status, started, finished, log_path=None):
+        self.host = host
+        self.status = status
+        self.started = started
+        self.finished = finished
+        self.log_path = log_path
+
+    @property
+    def ok(self):
+        return self.status == 0
+
+    @property
+    def duration(self):
+        return self.finished - self.started
+
+def _pump(stream, prefix, out, lock, log_file):
+    for line in iter(stream.readline, ""):
+        with lock:
+            out.write(prefix + line)
+            out.flush()
+            if log_file is not None:
+                log_file.write(line)
+    stream.close()
+
+def run_all(sessions, remote_cmd, limit=8, port=None, log_dir=None, out=sys.stdout):
+    """Runs `remote_cmd` on the host of each `remote.Session` in
+    `sessions`, at most `limit` at a time. Returns a `HostResult` per
+    session, in the same order."""
+
+    lock = threading.Lock()
+    width = max([len(s.host) for s in sessions] or [0])
+
+    if log_dir is not None and not opath.isdir(log_dir):
+        os.makedirs(log_dir)
+
+    def run_one(session):
+        log_path = opath.join(log_dir, "%s.log" % session.host) if log_dir is not None else None
+        log_file = open(log_path, "w") if log_path is not None else None
+
+        started = time.time()
+        proc = subp.Popen(session.command(remote_cmd, port), stdout=subp.PIPE, stderr=subp.PIPE)
+
+        pumps = [threading.Thread(target=_pump, args=(proc.stdout, "%-*s | " % (width, session.host), out, lock, log_file)),
+                 threading.Thread(target=_pump, args=(proc.stderr, "%-*s ! " % (width, session.host), out, lock, log_file))]
+        [p.start() for p in pumps]
+        [p.join() for p in pumps]
+
+        status = proc.wait()
+        finished = time.time()
+
+        if log_file is not None:
+            log_file.close()
+
+        return HostResult(session.host, status, started, finished, log_path)
+
+    if not sessions:
+        return []
+
+    pool = ThreadPool(min(limit, len(sessions)))
+    try:
+        results = pool.map(run_one, sessions)
+    finally:
+        pool.close()
+        pool.join()
+
+    for r in results:
+        log.info("%s: %s in %.1fs", r.host, "ok" if r.ok else "FAILED (%d)" % r.status, r.duration)
+
+    return results
+
+def run_step(sessions, script, args=(), **kwargs):
+    """Runs one of the setup scripts (setup_web.py, setup_ec2.py) with
+    `args` on every host; see `run_all`."""
+
+    return run_all(sessions, remote.remote_script(script, *args), **kwargs)
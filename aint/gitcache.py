@@ -0,0 +1,107 @@
+"""Git bundles of the /etc and site repositories.
+
+The control box keeps a mirror of each repository and, whenever its
+master moves, packs master into a bundle. Each host that gets the site
+(start_instance.site_server_types) is sent the bundles with its
+provisioning payload, clones from them locally, and then only fetches
+what is newer from the real remote, instead of every host cloning the
+whole history from the remote at once."""
+
+import logging
+import os
+import os.path as opath
+import subprocess as subp
+import tempfile as tempf
+import threading
+
+import runcmd as rc
+import settings
+
+log = logging.getLogger("gitcache")
+
+# Mirrors and bundles on the control box.
+cache_dir = opath.expanduser("~/.aint/git")
+bundle_dir = opath.join(cache_dir, "bundles")
+
+# Where the bundles go on the host, relative to the home directory.
+remote_dir = "setup_ec2/git"
+
+repos = {"etc": settings.etc_repo_uri,
+         "site": settings.site_repo_uri}
+
+def local_bundle(name):
+    """Returns the path of bundle `name` on this host, or None if the
+    host wasn't sent one."""
+
+    path = opath.expanduser("~/%s/%s.bundle" % (remote_dir, name))
+    return path if opath.exists(path) else None
+
+def update_mirror(name, uri):
+    """Creates or updates the mirror of `uri` and returns its path."""
+
+    path = opath.join(cache_dir, "%s.git" % name)
+    if not opath.isdir(path):
+        log.info("Mirroring %s", uri)
+        rc.run(["git", "clone", "--mirror", uri, path])
+    else:
+        rc.run(["git", "remote", "update", "--prune"], cwd=path)
+
+    return path
+
+def update_bundle(name, uri):
+    """Rebuilds bundle `name` if master has moved since it was built."""
+
+    mirror = update_mirror(name, uri)
+    with tempf.TemporaryFile() as commit_in:
+        rc.run(["git", "rev-parse", "master"], cwd=mirror, stdout=commit_in)
+        commit_in.seek(0)
+        commit = commit_in.read().strip()
+
+    path = opath.join(bundle_dir, "%s.bundle" % name)
+    commit_path = opath.join(bundle_dir, "%s.commit" % name)
+    if opath.exists(path) and opath.exists(commit_path) and open(commit_path).read().strip() == commit:
+        return
+
+    log.info("Bundling %s at %s", name, commit[:12])
+    if not opath.isdir(bundle_dir):
+        os.makedirs(bundle_dir)
+
+    tmp_path = path + ".tmp"
+    rc.run(["git", "bundle", "create", tmp_path, "master"], cwd=mirror)
+    if not rc.backend().live:
+        return
+
+    os.rename(tmp_path, path)
+    with open(commit_path, "w") as commit_out:
+        commit_out.write(commit + "\n")
+
+_built = False
+_build_lock = threading.Lock()
+def build():
+    """Brings the bundles up to date, once per run. A repository that
+    can't be fetched keeps its old bundle, if it has one: hosts fetch
+    the rest from the remote anyway."""
+
+    global _built
+
+    with _build_lock:
+        if _built:
+            return
+
+        for name, uri in sorted(repos.items()):
+            try:
+                update_bundle(name, uri)
+            except (subp.CalledProcessError, OSError), e:
+                log.warning("Couldn't update the %s bundle: %s", name, e)
+
+        _built = True
+
+def ship(session):
+    """Copies the bundles to the host behind `session` (a `remote.Session`)."""
+
+    build()
+    if not opath.isdir(bundle_dir):
+        return
+
+    session.run("mkdir -p %s" % remote_dir)
+    session.rsync(bundle_dir + "/", remote_dir + "/", excludes=["*.tmp"])
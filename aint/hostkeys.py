@@ -0,0 +1,169 @@
+"""Reads and rewrites ssh known_hosts files in a single pass.
+
+    python hostkeys.py <known_hosts> <file>...
+
+merges the entries in each <file> into <known_hosts>, skipping ones it
+already holds."""
+
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import os.path as opath
+import stat
+import sys
+import tempfile as tempf
+
+log = logging.getLogger("hostkeys")
+
+default_path = opath.expanduser("~/.ssh/known_hosts")
+
+def host_pattern(host, port=22):
+    """Returns the name ssh uses for `host` in known_hosts."""
+
+    if port == 22:
+        return host
+
+    return "[%s]:%d" % (host, port)
+
+def hash_host(host, salt):
+    """Returns the base64 HMAC-SHA1 that hashed entries store for `host`."""
+
+    return base64.b64encode(hmac.new(salt, host, hashlib.sha1).digest())
+
+class KnownHosts(object):
+    """A known_hosts file, indexed by host name and address.
+
+    Plain entries are indexed on each of their host names. Hashed
+    entries (|1|salt|hash) are indexed on their hash, and a host is
+    looked up by hashing it once with each distinct salt in the file.
+    Changes are kept in memory until `save` rewrites the file."""
+
+    def __init__(self, path=default_path):
+        self.path = path
+        self.changed = False
+        self.lines = []
+
+        if opath.exists(path):
+            with open(path) as kh_in:
+                self.lines = [l.rstrip("\n") for l in kh_in]
+
+        self._reindex()
+
+    def _reindex(self):
+        self._plain = {}
+        self._hashed = {}
+        self._salts = set()
+        self._entries = set()
+        self._keys = {}
+
+        for n, line in enumerate(self.lines):
+            self._index(n, line)
+
+    def _index(self, n, line):
+        fields = line.split()
+        if not fields or fields[0].startswith("#"):
+            return
+
+        marker = None
+        if fields[0].startswith("@"):
+            marker, fields = fields[0], fields[1:]
+        if len(fields) < 3:
+            return
+
+        self._entries.add(" ".join(fields[:3]))
+        self._keys[n] = (marker, fields[1], fields[2])
+
+        for host in fields[0].split(","):
+            if host.startswith("|1|"):
+                salt, hashed = host[3:].split("|", 1)
+                self._salts.add(base64.b64decode(salt))
+                self._hashed.setdefault(hashed, set()).add(n)
+            else:
+                self._plain.setdefault(host, set()).add(n)
+
+    def lookup(self, host):
+        """Returns the line numbers of the entries matching `host`."""
+
+        lines = set(self._plain.get(host, ()))
+        for salt in self._salts:
+            lines |= self._hashed.get(hash_host(host, salt), set())
+
+        return lines
+
+    def remove(self, hosts):
+        """Removes every entry for any of `hosts`, like ssh-keygen -R."""
+
+        drop = set()
+        for host in hosts:
+            drop |= self.lookup(host)
+
+        if not drop:
+            return
+
+        log.info("Removing %d known_hosts entries for %s", len(drop), ", ".join(hosts))
+        self.lines = [l for n, l in enumerate(self.lines) if n not in drop]
+        self.changed = True
+        self._reindex()
+
+    def has_key(self, host, key):
+        """Returns whether an entry for `host`, plain or hashed, has `key`
+        (a (marker, key type, key) tuple)."""
+
+        return any(self._keys.get(n) == key for n in self.lookup(host))
+
+    def add(self, lines):
+        """Adds the entries in `lines` that aren't already present, as
+        the same line or, for plain entries, as entries (hashed or not)
+        with the same key for each of their hosts."""
+
+        for line in lines:
+            line = line.strip()
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+
+            marker = fields[0] if fields[0].startswith("@") else None
+            key_fields = fields[1:] if marker else fields
+            if len(key_fields) < 3 or " ".join(key_fields[:3]) in self._entries:
+                continue
+
+            key = (marker, key_fields[1], key_fields[2])
+            hosts = key_fields[0].split(",")
+            if all(not h.startswith("|1|") and self.has_key(h, key) for h in hosts):
+                continue
+
+            self.lines.append(line)
+            self._index(len(self.lines) - 1, line)
+            self.changed = True
+
+    def merge(self, path):
+        """Adds the entries from the known_hosts file at `path`."""
+
+        with open(path) as kh_in:
+            self.add(kh_in)
+
+    def save(self):
+        """Atomically rewrites the file if anything changed."""
+
+        if not self.changed:
+            return
+
+        dir_name = opath.dirname(self.path) or "."
+        fd, tmp_path = tempf.mkstemp(dir=dir_name)
+        with os.fdopen(fd, "w") as kh_out:
+            kh_out.write("\n".join(self.lines) + "\n")
+
+        mode = stat.S_IMODE(os.stat(self.path).st_mode) if opath.exists(self.path) else 0644
+        os.chmod(tmp_path, mode)
+        os.rename(tmp_path, self.path)
+        self.changed = False
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    known_hosts = KnownHosts(sys.argv[1])
+    for path in sys.argv[2:]:
+        known_hosts.merge(path)
+    known_hosts.save()
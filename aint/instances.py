@@ -1,11 +1,55 @@
 import boto
+import boto.exception
 import itertools as itt
 import time
+import waiter as wt
+
+from boto.ec2.instance import Reservation
+from collections import OrderedDict
+
+# Instance states other than terminated.
+live_states = ("pending", "running", "shutting-down", "stopping", "stopped")
+
+# Number of instances requested per DescribeInstances page.
+page_size = 200
+
+def query_instances(ec2, instance_type=None, state=None, host_name=None, filters=None, page_size=page_size):
+    """Yields the instances matching the given predicates.
+
+    `instance_type`, `state` and `host_name` may be a value or a list of
+    values, and become DescribeInstances filters on the instance_type
+    tag, the instance state and the Name tag; `filters` adds any other
+    raw filters. Pages are fetched lazily, following NextToken."""
+
+    filters = dict(filters or {})
+    if instance_type is not None:
+        filters["tag:instance_type"] = instance_type
+    if state is not None:
+        filters["instance-state-name"] = state
+    if host_name is not None:
+        filters["tag:Name"] = host_name
+
+    params = {}
+    if filters:
+        ec2.build_filter_params(params, filters)
+    if page_size:
+        params["MaxResults"] = page_size
+
+    while True:
+        ress = ec2.get_list("DescribeInstances", params, [("item", Reservation)], verb="POST")
+
+        for res in ress:
+            for inst in res.instances:
+                yield inst
+
+        next_token = getattr(ress, "next_token", None)
+        if not next_token:
+            break
+
+        params["NextToken"] = next_token
 
 def walk_instances(ec2):
-    for res in ec2.get_all_instances():
-        for inst in res.instances:
-            yield inst
+    return query_instances(ec2)
 
 is_terminated = lambda i: i.state == "terminated"
 is_running = lambda i: i.state == "running"
@@ -24,9 +68,126 @@ can_batch = lambda i: is_celery(i)
 
 name = lambda i: str(i.tags[u"Name"])
 
+class Inventory(object):
+    """Indexed view of every instance in the account.
+
+    The account is swept at most once every `ttl` seconds; lookups by
+    id, Name and instance_type tag are dictionary lookups against the
+    last sweep. States are read from the instances themselves, so
+    `refresh` (which updates them in place) keeps lookups by state
+    current. Call `invalidate()` after anything that adds or removes
+    instances, or `update()` after changing a single instance's tags."""
+
+    def __init__(self, ec2, ttl=60):
+        self.ec2 = ec2
+        self.ttl = ttl
+        self.invalidate()
+
+    def invalidate(self):
+        """Forget the last sweep; the next lookup will sweep again."""
+
+        self.swept_at = None
+        self._by_id = OrderedDict()
+        self._by_name = {}
+        self._by_type = {}
+        self._keys = {}
+
+    def _sweep(self):
+        if self.swept_at is not None and time.time() - self.swept_at < self.ttl:
+            return
+
+        self.invalidate()
+        for i in walk_instances(self.ec2):
+            self._index(i)
+
+        self.swept_at = time.time()
+
+    def _index(self, i):
+        keys = (name(i) if u"Name" in i.tags else None, i.tags.get(u"instance_type"))
+
+        self._by_id[i.id] = i
+        self._keys[i.id] = keys
+        if keys[0] is not None:
+            self._by_name.setdefault(keys[0], OrderedDict())[i.id] = i
+        self._by_type.setdefault(keys[1], OrderedDict())[i.id] = i
+
+    def _unindex(self, instance_id):
+        host_name, itype = self._keys.pop(instance_id)
+        if host_name is not None:
+            del self._by_name[host_name][instance_id]
+        del self._by_type[itype][instance_id]
+
+    def update(self, instance):
+        """Re-index `instance` after its tags changed locally."""
+
+        self._sweep()
+
+        if instance.id in self._by_id:
+            self._unindex(instance.id)
+
+        self._index(instance)
+
+    def start(self, instances):
+        """Starts `instances` and invalidates the inventory."""
+
+        [i.start() for i in instances]
+        self.invalidate()
+
+    def stop(self, instances):
+        """Stops `instances` and invalidates the inventory."""
+
+        [i.stop() for i in instances]
+        self.invalidate()
+
+    def __iter__(self):
+        self._sweep()
+        return iter(self._by_id.values())
+
+    def __len__(self):
+        self._sweep()
+        return len(self._by_id)
+
+    def get(self, instance_id):
+        """Returns the instance with id `instance_id`, or `None`."""
+
+        self._sweep()
+        return self._by_id.get(instance_id)
+
+    def named(self, host_name):
+        """Returns the instances tagged with Name `host_name`."""
+
+        self._sweep()
+        return self._by_name.get(host_name, {}).values()
+
+    def of_type(self, instance_type, state=None):
+        """Returns the instances with tag instance_type `instance_type`,
+        optionally only those in state `state`."""
+
+        self._sweep()
+
+        insts = self._by_type.get(instance_type, {}).values()
+        if state is None:
+            return insts
+
+        return [i for i in insts if i.state == state]
+
+    def in_state(self, state):
+        """Returns the instances in state `state`."""
+
+        self._sweep()
+        return [i for i in self._by_id.values() if i.state == state]
+
+_inventories = {}
+def inventory(ec2, ttl=60):
+    """Returns the shared `Inventory` for the connection `ec2`."""
+
+    if ec2 not in _inventories:
+        _inventories[ec2] = Inventory(ec2, ttl=ttl)
+
+    return _inventories[ec2]
+
 def deployable_instances(ec2):
-    for inst in (i for i in walk_instances(ec2) if should_deploy(i)):
-        yield inst
+    return query_instances(ec2, instance_type=["celery", "web", "solr"], state="running")
 
 def hostname(instance):
     import adns
@@ -40,23 +201,72 @@ connect = lambda: boto.connect_ec2()
 def reservation_instances(ec2, res):
     """Returns the most current instances from a reservation."""
 
-    ress = [r for r in ec2.get_all_instances() if r.id == res.id]
+    ress = ec2.get_all_instances(filters={"reservation-id": res.id})
     if not len(ress):
         raise KeyError("Reservation %s not found." % res.id)
 
     res = ress[0]
     return tuple(i for i in res.instances)
 
+def refresh(ec2, instances):
+    """Updates `instances` in place with a single DescribeInstances
+    call filtered on their ids. Instances EC2 doesn't know about yet,
+    as just after they are launched, are left as they are for now."""
+
+    by_id = dict((i.id, i) for i in instances)
+    if not by_id:
+        return
+
+    try:
+        ress = ec2.get_all_instances(instance_ids=by_id.keys())
+    except boto.exception.EC2ResponseError, e:
+        if e.error_code != "InvalidInstanceID.NotFound":
+            raise
+        return
+
+    for res in ress:
+        for fresh in res.instances:
+            if fresh.id in by_id:
+                by_id[fresh.id]._update(fresh)
+
+def pending(ec2, instances, status):
+    """Refreshes `instances` and returns those not yet in state `status`."""
+
+    refresh(ec2, instances)
+
+    return [i for i in instances if i.state != status]
+
 def all_status(ec2, instances, status):
     """Returns `True` if all instances are in state `status`."""
 
-    [i.update() for i in instances]
-
     try:
-        return all(i.state==status for i in instances)
+        return not pending(ec2, instances, status)
     except KeyError:
         return False
 
+def wait_for_state(ec2, instances, status, on_met=None, timeout=None, waiter=None):
+    """Waits for each of `instances` to reach state `status`.
+
+    All still-pending instances are refreshed with one describe call per
+    poll, and `on_met(instance)` is called as soon as each instance gets
+    there. If `waiter` is given the conditions are added to it and the
+    caller runs it; otherwise this blocks until all are done."""
+
+    own_waiter = waiter is None
+    if own_waiter:
+        waiter = wt.Waiter()
+
+    waiter.add_hook(lambda: refresh(ec2, [i for i in instances if i.state != status]))
+
+    for inst in instances:
+        waiter.add(lambda inst=inst: inst.state == status,
+                   on_met=(lambda inst=inst: on_met(inst)) if on_met is not None else None,
+                   timeout=timeout,
+                   name="%s %s" % (inst.id, status))
+
+    if own_waiter:
+        waiter.run()
+
 def all_running(ec2, instances):
     """Returns `True` if all instances in `res` are running."""
 
@@ -0,0 +1,79 @@
+"""Persistent record of the setup steps completed on a host, so that a
+re-run after a failure resumes from the first step that didn't finish."""
+
+import hashlib
+import json
+import logging
+import os
+import os.path as opath
+import tempfile as tempf
+import threading
+import time
+
+log = logging.getLogger("journal")
+
+default_path = opath.expanduser("~/.aint/journal.json")
+
+def input_hash(name, args):
+    """Returns a hash of a step's name and arguments."""
+
+    return hashlib.sha1(json.dumps([name, list(args)], sort_keys=True)).hexdigest()
+
+class Journal(object):
+    """Completed steps, keyed by step name and input hash.
+
+    `run` skips a step that has already completed with the same
+    arguments, unless its name is in `force`. A step whose arguments
+    changed runs again."""
+
+    def __init__(self, path=default_path, force=()):
+        self.path = path
+        self.force = set(force)
+        self.steps = {}
+        self._lock = threading.Lock()
+
+        if opath.exists(path):
+            with open(path) as journal_in:
+                self.steps = json.load(journal_in)
+
+    def done(self, name, args=()):
+        step = self.steps.get(name)
+        return step is not None and step["hash"] == input_hash(name, args)
+
+    def record(self, name, args=()):
+        # Steps may finish concurrently (see steps.Plan).
+        with self._lock:
+            self.steps[name] = {"hash": input_hash(name, args), "finished": time.time()}
+            self.save()
+
+    def save(self):
+        dir_name = opath.dirname(self.path)
+        if not opath.isdir(dir_name):
+            os.makedirs(dir_name)
+
+        fd, tmp_path = tempf.mkstemp(dir=dir_name)
+        with os.fdopen(fd, "w") as journal_out:
+            json.dump(self.steps, journal_out, indent=1, sort_keys=True)
+
+        os.rename(tmp_path, self.path)
+
+    def run(self, name, func, *args):
+        """Runs `func(*args)` as step `name` unless it's already done."""
+
+        if name not in self.force and self.done(name, args):
+            log.info("Skipping %s: already done", name)
+            return
+
+        func(*args)
+        self.record(name, args)
+
+class NullJournal(Journal):
+    """A journal that runs every step and remembers nothing."""
+
+    def __init__(self):
+        self.force = set()
+        self.steps = {}
+        self._lock = threading.Lock()
+
+    def save(self):
+        pass
@@ -0,0 +1,176 @@
+"""Sizes the MySQL settings in my.cnf to the machine.
+
+The settings follow from the instance's memory and vCPUs, how much of
+the machine MySQL gets (its profile), and the storage layout. Render a
+profile to review it before it reaches a host:
+
+    python mycnf.py --instance-type m2.4xlarge --devices 4
+    python mycnf.py --host-type backupdb"""
+
+import argparse
+import logging
+import multiprocessing
+import platform
+import urllib2
+
+import ec2types
+
+log = logging.getLogger("mycnf")
+
+class Profile(object):
+    """How much of the machine MySQL gets: the share of memory for the
+    buffer pool, the memory kept back for the OS and everything else,
+    and the connection limit."""
+
+    def __init__(self, pool_share, reserve_gb, max_connections):
+        self.pool_share = pool_share
+        self.reserve_gb = reserve_gb
+        self.max_connections = max_connections
+
+profiles = {
+    # A database server: MySQL has the machine to itself.
+    "dedicated": Profile(0.8, 2, 1000),
+    # Staging runs the whole site on one box.
+    "shared": Profile(0.25, 2, 200),
+    }
+
+host_profiles = {"mysql": "dedicated", "backupdb": "dedicated", "staging": "shared"}
+
+# Sustained random write IOPS of one standard EBS volume, and of the
+# instance store when there is no array.
+volume_iops = 100
+instance_store_iops = 200
+
+metadata_url = "http://169.254.169.254/latest/meta-data/instance-type"
+
+def local_instance_type(default=None):
+    """Returns this host's EC2 instance type from the instance metadata,
+    or `default` if the metadata can't be read and `default` is set."""
+
+    try:
+        return urllib2.urlopen(metadata_url, timeout=2).read().strip()
+    except (urllib2.URLError, IOError), e:
+        if default is None:
+            raise
+        log.warning("Couldn't read the instance type (%s); assuming %s", e, default)
+        return default
+
+def local_spec():
+    """Returns this machine's memory (from /proc/meminfo) and vCPUs as an
+    `ec2types.InstanceType`."""
+
+    with open("/proc/meminfo") as meminfo:
+        fields = dict(line.split(":", 1) for line in meminfo)
+    memory_kb = int(fields["MemTotal"].split()[0])
+
+    bits = 64 if platform.machine() == "x86_64" else 32
+    return ec2types.InstanceType(memory_kb / 1024.0 / 1024, multiprocessing.cpu_count(), bits)
+
+def instance_spec(instance_type, local=False):
+    """Returns the `ec2types.InstanceType` for `instance_type`. A type
+    missing from the table is an error, unless `local` is set, meaning
+    this is the instance itself: then its spec is read from the machine."""
+
+    spec = ec2types.types.get(instance_type)
+    if spec is not None:
+        return spec
+
+    if not local:
+        raise ValueError("Unknown instance type %s; add it to ec2types.types" % instance_type)
+
+    spec = local_spec()
+    log.warning("Unknown instance type %s; sizing for this machine's %.1fGB and %d vCPUs",
+                instance_type, spec.memory_gb, spec.vcpus)
+    return spec
+
+def clamp(value, low, high):
+    return max(low, min(high, value))
+
+def mb(value):
+    return "%dM" % value
+
+def settings(spec, profile, layout=None):
+    """Returns the my.cnf settings for an instance with `spec` running
+    MySQL under `profile`, with its data on `layout` (a
+    `storage.StoragePlan`, or None for the instance store), as a dict of
+    setting name to value."""
+
+    memory_mb = spec.memory_gb * 1024
+    usable_mb = max(256, memory_mb - profile.reserve_gb * 1024)
+
+    pool_mb = int(clamp(memory_mb * profile.pool_share, 128, usable_mb))
+    pool_mb -= pool_mb % 128
+
+    # Per-connection buffers come out of what the buffer pool leaves,
+    # assuming no more than a quarter of connections are busy at once.
+    per_connection_kb = max(0, usable_mb - pool_mb) * 1024 * 4 / profile.max_connections
+
+    # Two redo log files totalling a quarter of the pool, up to 1GB each.
+    log_file_mb = int(clamp(pool_mb / 8, 64, 1024))
+
+    if layout is not None:
+        io_capacity = volume_iops * layout.data_disks
+    else:
+        io_capacity = instance_store_iops
+
+    table_open_cache = int(clamp(profile.max_connections * 2, 400, 4096))
+
+    return {"max_connections": profile.max_connections,
+            "innodb_buffer_pool_size": "%dG" % (pool_mb / 1024) if pool_mb % 1024 == 0 else mb(pool_mb),
+            "innodb_buffer_pool_instances": clamp(pool_mb / 1024, 1, 8),
+            "innodb_log_file_size": mb(log_file_mb),
+            "innodb_io_capacity": max(100, io_capacity),
+            "innodb_read_io_threads": max(4, spec.vcpus),
+            "innodb_write_io_threads": max(4, spec.vcpus),
+            "thread_concurrency": spec.vcpus * 2,
+            "thread_cache_size": clamp(8 + profile.max_connections / 100, 8, 100),
+            "table_open_cache": table_open_cache,
+            "table_definition_cache": 400 + table_open_cache / 2,
+            "sort_buffer_size": "%dK" % clamp(per_connection_kb / 4, 256, 2048),
+            "join_buffer_size": "%dK" % clamp(per_connection_kb / 4, 256, 2048),
+            "read_buffer_size": "%dK" % clamp(per_connection_kb / 8, 128, 1024),
+            "read_rnd_buffer_size": "%dK" % clamp(per_connection_kb / 8, 256, 1024),
+            }
+
+def render(template, values):
+    """Fills the %(name)s placeholders in the my.cnf template."""
+
+    return template % values
+
+def describe(values):
+    return ["%-32s = %s" % (k, values[k]) for k in sorted(values)]
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Show the MySQL settings for an instance.")
+    parser.add_argument("--host-type", choices=sorted(host_profiles),
+                        help="take the instance type and profile from the host type")
+    parser.add_argument("--instance-type", choices=sorted(ec2types.types))
+    parser.add_argument("--profile", choices=sorted(profiles))
+    parser.add_argument("--devices", type=int, default=0, help="EBS volumes in the data array (default: none)")
+    args = parser.parse_args()
+
+    import storage
+
+    instance_type, profile, devices = args.instance_type, args.profile, args.devices
+    if args.host_type is not None:
+        # Needs boto, so only on the control box.
+        import start_instance
+        import setup_ec2
+
+        instance_type = instance_type or start_instance.server_types[args.host_type][0]
+        profile = profile or host_profiles[args.host_type]
+        if not devices and args.host_type in start_instance.storage_server_types:
+            devices = len(setup_ec2.raid_phys_devs)
+
+    if instance_type is None:
+        parser.error("give --host-type or --instance-type")
+
+    layout = None
+    if devices:
+        layout = storage.StoragePlan(["/dev/xvd%s" % chr(ord("f") + i) for i in xrange(devices)])
+    print "# %s, %s profile, %s" % (instance_type, profile or "dedicated",
+                                    layout.describe() if layout else "instance store")
+    for line in describe(settings(instance_spec(instance_type), profiles[profile or "dedicated"], layout)):
+        print line
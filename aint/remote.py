@@ -0,0 +1,168 @@
+"""SSH sessions to provisioned hosts.
+
+Every ssh and rsync invocation for a host goes through one multiplexed
+master connection, so the TCP, key exchange and authentication
+handshake happens once per host rather than once per command."""
+
+import errno
+import hashlib
+import logging
+import os
+import os.path as opath
+import pipes
+import select
+import socket
+import subprocess as subp
+import time
+
+import timeline
+
+log = logging.getLogger("remote")
+
+# Directory holding the ssh control sockets.
+control_dir = opath.expanduser("~/.aint/ssh")
+
+# Where the setup scripts are on a host, relative to the home directory.
+script_dir = "setup_ec2/aws"
+
+def trace_name(script):
+    return "trace-%s.json" % opath.splitext(script)[0]
+
+def remote_script(script, *args):
+    """Returns the remote command that runs one of the setup scripts.
+    When this run is traced, the script writes its own trace next to it."""
+
+    trace = ""
+    if timeline.trace_path:
+        trace = "AINT_TRACE=%s " % trace_name(script)
+
+    return "cd %s && %spython %s %s" % (script_dir, trace, script, " ".join(args))
+
+def probe_ssh(hosts, port=22, timeout=5):
+    """Returns the subset of `hosts` with an ssh server answering on
+    `port`.
+
+    All hosts are probed at once with non-blocking connects, and a host
+    only counts once it has sent an SSH banner. That's far cheaper than
+    running ssh against hosts that are still booting."""
+
+    connecting = {}
+    for host in hosts:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        try:
+            err = sock.connect_ex((host, port))
+        except socket.error:
+            sock.close()
+            continue
+
+        if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            connecting[sock] = host
+        else:
+            sock.close()
+
+    reading = {}
+    ready = set()
+    deadline = time.time() + timeout
+    while (connecting or reading) and time.time() < deadline:
+        r, w, x = select.select(reading.keys(), connecting.keys(), [], max(0, deadline - time.time()))
+
+        for sock in w:
+            host = connecting.pop(sock)
+            if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                sock.close()
+            else:
+                reading[sock] = host
+
+        for sock in r:
+            host = reading.pop(sock)
+            try:
+                if sock.recv(64).startswith("SSH-"):
+                    ready.add(host)
+            except socket.error:
+                pass
+            sock.close()
+
+    [sock.close() for sock in connecting.keys() + reading.keys()]
+
+    return ready
+
+class Session(object):
+    """ssh access to `user`@`host` over a shared master connection.
+
+    The control socket is keyed on user and host but not port, so a
+    master opened on port 22 keeps serving commands addressed to port
+    2000 after configure_ssh moves sshd there: restarting sshd doesn't
+    drop established connections."""
+
+    def __init__(self, host, user="ubuntu", key_path=None, port=22, persist=600, connect_timeout=30):
+        self.host = host
+        self.user = user
+        self.key_path = key_path
+        self.port = port
+        self.persist = persist
+        self.connect_timeout = connect_timeout
+
+    @property
+    def user_host(self):
+        return "%s@%s" % (self.user, self.host)
+
+    @property
+    def control_path(self):
+        # Socket paths are limited to ~100 characters, so hash the host name.
+        return opath.join(control_dir, hashlib.sha1(self.user_host).hexdigest()[:16])
+
+    def ssh_options(self, port=None):
+        if not opath.isdir(control_dir):
+            os.makedirs(control_dir, 0700)
+
+        opts = ["-o", "ControlMaster=auto",
+                "-o", "ControlPath=%s" % self.control_path,
+                "-o", "ControlPersist=%d" % self.persist,
+                "-o", "ConnectTimeout=%d" % self.connect_timeout,
+                "-p", str(port or self.port)]
+        if self.key_path is not None:
+            opts = ["-i", self.key_path] + opts
+
+        return opts
+
+    def command(self, remote_cmd, port=None, tty=False):
+        """Returns the ssh command line that runs `remote_cmd` on the host."""
+
+        return ["ssh"] + self.ssh_options(port) + (["-t"] if tty else []) + [self.user_host, remote_cmd]
+
+    def call(self, remote_cmd, port=None, tty=False, **kwargs):
+        """Runs `remote_cmd` on the host and returns its exit status."""
+
+        return subp.call(self.command(remote_cmd, port, tty), **kwargs)
+
+    def run(self, remote_cmd, port=None, tty=False, **kwargs):
+        """Runs `remote_cmd` on the host, raising CalledProcessError if it fails."""
+
+        subp.check_call(self.command(remote_cmd, port, tty), **kwargs)
+
+    def rsync_command(self, excludes=(), port=None):
+        ssh = " ".join(pipes.quote(a) for a in ["ssh"] + self.ssh_options(port))
+        cmd = ["rsync", "-a", "-e", ssh]
+        for exclude in excludes:
+            cmd += ["--exclude", exclude]
+
+        return cmd
+
+    def rsync(self, src, dest, excludes=(), port=None):
+        """Copies local `src` to `dest` on the host with rsync."""
+
+        subp.check_call(self.rsync_command(excludes, port) + [src, "%s:%s" % (self.user_host, dest)])
+
+    def fetch(self, src, dest, excludes=(), port=None):
+        """Copies `src` on the host to local `dest` with rsync."""
+
+        subp.check_call(self.rsync_command(excludes, port) + ["%s:%s" % (self.user_host, src), dest])
+
+    def close(self):
+        """Shuts the master connection down, if there is one."""
+
+        if opath.exists(self.control_path):
+            log.info("Closing ssh connection to %s", self.host)
+            subp.call(["ssh", "-o", "ControlPath=%s" % self.control_path, "-O", "exit", self.user_host],
+                      stderr=open(os.devnull, "w"))
@@ -5,12 +5,21 @@ import traceback as tb
 import os.path as opath
 import os
 import logging
+import pipes
+import re
+import tempfile as tempf
+import threading
+import contextlib
+import json
+import time
+import timeline
+import waiter
 
 log = logging.getLogger("runcmd")
 
 HOSTNAME = socket.gethostname()
 
-rsrc_path = lambda rsrc: opath.join(opath.dirname(__file__), rsrc)
+rsrc_path = lambda rsrc: opath.join(opath.dirname(opath.abspath(__file__)), rsrc)
 
 def create_ssh_key(user):
     key_path = opath.expanduser("~%s/.ssh/id_rsa" % user)
@@ -76,14 +85,307 @@ def run_as_user(cmd, user, path=None, **kwargs):
     return check_sudo(cmd, cwd=path, **kwargs)
 
 
+_temp_paths = set()
+_temp_lock = threading.Lock()
+
+def temp_file(**kwargs):
+    """Like `tempfile.mkstemp`, but commands naming the file still match
+    in replays (see `command_key`)."""
+
+    fd, path = tempf.mkstemp(**kwargs)
+    with _temp_lock:
+        _temp_paths.add(path)
+
+    return fd, path
+
+def temp_dir(**kwargs):
+    """Like `tempfile.mkdtemp`; see `temp_file`."""
+
+    path = tempf.mkdtemp(**kwargs)
+    with _temp_lock:
+        _temp_paths.add(path)
+
+    return path
+
+def command_key(cmd):
+    """Returns the key a recorded command is replayed under.
+
+    Paths that change from run to run are replaced by placeholders:
+    those made by `temp_file` and `temp_dir` by <tmp>, and the resource
+    and scratch directories (see `output_path`) by <rsrc>. Sudo batches
+    pass a temporary status file as their last argument, which is left
+    out."""
+
+    cmd = list(cmd)
+    if cmd[-2:-1] == ["sudo-batch"]:
+        cmd = cmd[:-1]
+
+    with _temp_lock:
+        paths = [(p, "<tmp>") for p in _temp_paths]
+    paths += [(d, "<rsrc>") for d in (opath.dirname(rsrc_path("")), _scratch_dir) if d]
+    # Longest first, so a temporary file inside a scratch directory
+    # isn't half replaced.
+    paths.sort(key=lambda (p, _): len(p), reverse=True)
+
+    def normalise(arg):
+        if isinstance(arg, basestring):
+            for path, placeholder in paths:
+                arg = arg.replace(path, placeholder)
+        return arg
+
+    return json.dumps([normalise(arg) for arg in cmd])
+
+class LocalBackend(object):
+    """Runs commands on this machine."""
+
+    live = True
+
+    def call(self, cmd, *args, **kwargs):
+        return subp.call(cmd, *args, **kwargs)
+
+class DryRunBackend(object):
+    """Logs commands instead of running them; they all succeed."""
+
+    live = False
+
+    def __init__(self):
+        self.commands = []
+
+    def call(self, cmd, *args, **kwargs):
+        if cmd[-2:-1] == ["sudo-batch"]:
+            log.info("Would run sudo batch:\n%s", cmd[3].rstrip())
+        else:
+            log.info("Would run: %s", cmd)
+        self.commands.append(list(cmd))
+        return 0
+
+class RecordingBackend(LocalBackend):
+    """Runs commands on this machine, appending each command with its
+    exit status and duration to the JSON-lines file at `path`."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def call(self, cmd, *args, **kwargs):
+        start = time.time()
+        status = LocalBackend.call(self, cmd, *args, **kwargs)
+
+        entry = {"key": command_key(cmd), "cmd": list(cmd), "cwd": kwargs.get("cwd"),
+                 "status": status, "duration": time.time() - start}
+        with self._lock:
+            with open(self.path, "a") as rec_out:
+                rec_out.write(json.dumps(entry) + "\n")
+
+        return status
+
+class ReplayBackend(object):
+    """Replays a recording made by `RecordingBackend`.
+
+    Each command returns its recorded exit status after sleeping for
+    its recorded duration times `speed`. Commands are matched to the
+    recording by command line (see `command_key`), in recorded order,
+    so steps may run in a different order than they were recorded in.
+    Commands missing from the recording succeed immediately, with a
+    warning."""
+
+    live = False
+
+    def __init__(self, path, speed=1.0):
+        self.speed = speed
+        self.entries = {}
+        self._lock = threading.Lock()
+
+        with open(path) as rec_in:
+            for line in rec_in:
+                entry = json.loads(line)
+                self.entries.setdefault(entry["key"], []).append(entry)
+
+    def call(self, cmd, *args, **kwargs):
+        with self._lock:
+            entries = self.entries.get(command_key(cmd))
+            entry = entries.pop(0) if entries else None
+
+        if entry is None:
+            log.warning("Command %s is not in the recording", cmd)
+            return 0
+
+        time.sleep(entry["duration"] * self.speed)
+        return entry["status"]
+
+_backend = LocalBackend()
+
+def backend():
+    """Returns the backend `run` executes commands with."""
+
+    return _backend
+
+def set_backend(new_backend):
+    global _backend
+
+    _backend = new_backend
+
+def backend_from_spec(spec):
+    """Returns the backend named by `spec`: local, dry-run, record:PATH
+    or replay:PATH[:SPEED]."""
+
+    kind, _, arg = spec.partition(":")
+    if kind == "local":
+        return LocalBackend()
+    if kind == "dry-run":
+        return DryRunBackend()
+    if kind == "record":
+        return RecordingBackend(arg)
+    if kind == "replay":
+        path, _, speed = arg.partition(":")
+        return ReplayBackend(path, float(speed or 1))
+
+    raise ValueError("Unknown backend %s" % spec)
+
+if os.environ.get("AINT_BACKEND"):
+    set_backend(backend_from_spec(os.environ["AINT_BACKEND"]))
+
+_scratch_dir = None
+_scratch_lock = threading.Lock()
+def output_path(name):
+    """Returns where to write generated file `name` before installing
+    it: next to the resources, or in a scratch directory when the
+    backend isn't live, so offline runs leave the package alone."""
+
+    global _scratch_dir
+
+    if backend().live:
+        return rsrc_path(name)
+
+    with _scratch_lock:
+        if _scratch_dir is None:
+            _scratch_dir = tempf.mkdtemp(prefix="aint-offline-")
+            log.info("Writing generated files to %s", _scratch_dir)
+
+    return opath.join(_scratch_dir, name)
+
+home_re = re.compile(r"^~[A-Za-z0-9_.-]*(?=/|$)")
+
+def shell_word(arg):
+    """Quotes `arg` for the shell, leaving a leading ~user unquoted so it
+    expands when the script runs: the user may be created earlier in
+    the same batch, so it can't be expanded when the command is queued."""
+
+    m = home_re.match(arg)
+    if m is None:
+        return pipes.quote(arg)
+
+    # The slash after ~user must be unquoted too, or the shell won't
+    # expand it.
+    rest = arg[m.end() + 1:]
+    return m.group(0) + ("/" + pipes.quote(rest) if rest else arg[m.end():])
+
+class SudoBatch(object):
+    """`check_sudo` commands queued inside a `sudo_batch` block."""
+
+    def __init__(self):
+        self.commands = []
+
+    def add(self, cmd, cwd=None):
+        self.commands.append((list(cmd), cwd))
+
+    def script(self):
+        """Returns a shell script running the queued commands in order.
+        It stops at the first failure, writing the index of the failed
+        command to the file named by its first argument."""
+
+        lines = []
+        for n, (cmd, cwd) in enumerate(self.commands):
+            # Commands starting with sudo options (-u user -H ...) still need sudo.
+            if cmd[0].startswith("-"):
+                cmd = ["sudo"] + cmd
+
+            line = " ".join(shell_word(a) for a in cmd)
+            if cwd is not None:
+                line = "(cd %s && %s)" % (shell_word(opath.expanduser(cwd)), line)
+
+            lines.append('%s || { s=$?; echo %d > "$1"; exit $s; }' % (line, n))
+
+        return "\n".join(lines) + "\n"
+
+    def flush(self):
+        """Runs the queued commands under a single sudo."""
+
+        if not self.commands:
+            return
+
+        script = self.script()
+        commands, self.commands = self.commands, []
+
+        fd, status_path = tempf.mkstemp(prefix="sudo-batch-")
+        os.close(fd)
+        try:
+            log.info("Running %d commands in one sudo batch", len(commands))
+            with timeline.span("sudo batch of %d" % len(commands), "command", script=script) as trace:
+                trace["exit_status"] = backend().call(["sudo", "/bin/sh", "-c", script, "sudo-batch", status_path])
+                if trace["exit_status"]:
+                    raise subp.CalledProcessError(trace["exit_status"], "sudo-batch")
+        except subp.CalledProcessError, e:
+            with open(status_path) as status_in:
+                status = status_in.read().strip()
+
+            failed = commands[int(status)][0] if status else ["sudo-batch"]
+            log.error("Command %s failed with status: %d", ["sudo"] + failed, e.returncode)
+            raise subp.CalledProcessError(e.returncode, ["sudo"] + failed)
+        finally:
+            os.remove(status_path)
+
+_batches = threading.local()
+
+@contextlib.contextmanager
+def sudo_batch():
+    """Queues the `check_sudo` commands run inside the block and runs
+    them as one script under a single sudo when the block ends.
+
+    Commands run in order and the batch stops at the first failure,
+    raising CalledProcessError for that command. Commands that can't be
+    queued (e.g. with `stdin`) and plain `run` calls run the queue
+    first. Nested blocks join the outer batch."""
+
+    if getattr(_batches, "current", None) is not None:
+        yield _batches.current
+        return
+
+    batch = _batches.current = SudoBatch()
+    try:
+        yield batch
+    except:
+        exc_info = sys.exc_info()
+        try:
+            batch.flush()
+        except Exception:
+            log.error("Sudo batch failed while handling an earlier error")
+        raise exc_info[0], exc_info[1], exc_info[2]
+    else:
+        batch.flush()
+    finally:
+        _batches.current = None
+
 def check_sudo(cmd, *args, **kwargs):
+    batch = getattr(_batches, "current", None)
+    if batch is not None and not args and set(kwargs) <= set(["cwd"]):
+        batch.add(cmd, **kwargs)
+        return
+
     cmd = ["sudo"] + list(cmd)
 
     run(cmd, *args, **kwargs)
 
 def run(cmd, *args, **kwargs):
+    batch = getattr(_batches, "current", None)
+    if batch is not None:
+        batch.flush()
+
     try:
-        subp.check_call(cmd, *args, **kwargs)
+        with timeline.span(" ".join(cmd)[:80], "command", cmd=cmd) as trace:
+            trace["exit_status"] = backend().call(cmd, *args, **kwargs)
+            if trace["exit_status"]:
+                raise subp.CalledProcessError(trace["exit_status"], cmd)
     except subp.CalledProcessError, e:
         log.error("Command %s failed with status: %d", cmd, e.returncode)
         raise
@@ -92,14 +394,8 @@ def run(cmd, *args, **kwargs):
         log.error(tb.format_exc())
         raise
 
-def wait(func):
-    """Calls `cond` in an exponential-backoff loop until it returns `True`."""
-
-    for i in itt.count(0):
-        if func():
-            break
-
-        if i > 5:
-            i = 5
+def wait(func, timeout=None):
+    """Calls `func` in an exponential-backoff loop until it returns
+    `True`, raising `waiter.WaitTimeout` after `timeout` seconds."""
 
-        time.sleep(0.25 * (2**i))
+    waiter.wait(func, timeout=timeout)
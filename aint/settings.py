@@ -12,6 +12,9 @@ etc_repo_uri = "git@memrise.unfuddle.com:memrise/etc.git"
 etc_repo_email = "info@memrise.com"
 etc_repo_user = "Atunit root"
 
+# Site repository, checked out as memrise.
+site_repo_uri = "git@memrise.unfuddle.com:memrise/memrise-django.git"
+
 # Name of apache configuration to use after checking out the /etc
 # configuration.
 site_config_name = "memrise"
@@ -7,8 +7,16 @@ import traceback as tb
 import socket
 import itertools as itt
 import os
+import argparse
+import artifacts
+import journal
+import multiprocessing
+import mycnf
 import runcmd
-import tempfile as tempf
+import steps
+import storage
+import timeline
+import time
 
 logging.basicConfig(level=logging.INFO)
 
@@ -55,108 +63,187 @@ INSTALL_PYTHON_PACKAGES = ["pip",
                            "virtualenv",
                            "argparse"]
 
+@timeline.traced
 def create_memrise_user():
-    runcmd.check_sudo(["groupadd", "memrise"])
-    runcmd.check_sudo(["useradd", "-g", "memrise", "-G", "admin", "-s", "/bin/bash", "-m", "memrise"])
-
-    runcmd.install_dirs(["~memrise/log", 
-                  "~memrise/memrise",],
-                 owner="memrise",
-                 group="memrise", 
-                 mode="0700")
-
+    with runcmd.sudo_batch():
+        runcmd.check_sudo(["groupadd", "memrise"])
+        runcmd.check_sudo(["useradd", "-g", "memrise", "-G", "admin", "-s", "/bin/bash", "-m", "memrise"])
+
+        runcmd.install_dirs(["~memrise/log", 
+                      "~memrise/memrise",],
+                     owner="memrise",
+                     group="memrise", 
+                     mode="0700")
+
+@timeline.traced
+def generate_memrise_ssh_key():
     runcmd.create_ssh_key("memrise")
 
+@timeline.traced
 def generate_root_ssh_key():
     runcmd.create_ssh_key("root")
 
+@timeline.traced
 def upgrade_install_packages():
-    runcmd.apt_get(["update"])
-    runcmd.apt_get(["upgrade"])
-    runcmd.apt_get(["install"] + INSTALL_PACKAGES)
-    runcmd.check_sudo(["easy_install"] + INSTALL_PYTHON_PACKAGES)
+    with runcmd.sudo_batch():
+        runcmd.apt_get(["update"])
+        runcmd.apt_get(["upgrade"])
+        runcmd.apt_get(["install"] + INSTALL_PACKAGES)
+        runcmd.check_sudo(["easy_install"] + INSTALL_PYTHON_PACKAGES)
 
+@timeline.traced
 def configure_ssh():
-    runcmd.install_files("/etc/ssh", ["sshd_config"])
-    runcmd.restart_service("ssh")
+    with runcmd.sudo_batch():
+        runcmd.install_files("/etc/ssh", ["sshd_config"])
+        runcmd.restart_service("ssh")
 
-def install_mysql():
-    log.info("Downloading MySQL 5.5.19 Source")
-    runcmd.run(["wget", "-O", "mysql-5.5.19.tar.gz",
-                "http://dev.mysql.com/get/Downloads/MySQL-5.5/mysql-5.5.19.tar.gz/from/http://mysql.he.net/"])
+MYSQL_VERSION = "5.5.19"
+MYSQL_PREFIX = "/usr/local/mysql"
+MYSQL_CMAKE_FLAGS = ["-DCMAKE_INSTALL_PREFIX=%s" % MYSQL_PREFIX]
+
+def mysql_artifact_key():
+    return artifacts.artifact_key(version=MYSQL_VERSION, flags=MYSQL_CMAKE_FLAGS)
+
+def mysql_cache():
+    return artifacts.ArtifactCache(opath.expanduser("~/" + artifacts.remote_dir))
+
+MYSQL_SRC_DIR = "mysql-%s" % MYSQL_VERSION
+
+@timeline.traced
+def download_mysql():
+    """Downloads and unpacks the MySQL source, unless a build is cached."""
+
+    if mysql_cache().get("mysql", mysql_artifact_key()) is not None:
+        return
+
+    log.info("Downloading MySQL %s Source", MYSQL_VERSION)
+    runcmd.run(["wget", "-O", "%s.tar.gz" % MYSQL_SRC_DIR,
+                "http://dev.mysql.com/get/Downloads/MySQL-5.5/%s.tar.gz/from/http://mysql.he.net/" % MYSQL_SRC_DIR])
+
+    log.info("Unpacking MySQL %s Source", MYSQL_VERSION)
+    runcmd.run(["tar", "xzf", "%s.tar.gz" % MYSQL_SRC_DIR])
 
-    log.info("Unpacking MySQL 5.5.19 Source")
-    runcmd.run(["tar", "xzf", "mysql-5.5.19.tar.gz"])
+@timeline.traced
+def build_mysql():
+    """Builds the downloaded MySQL source into an artifact in the cache,
+    unless one is cached. The artifact is a tarball of the installed
+    tree, to be extracted at /."""
 
-    log.info("Configuring MySQL 5.5.19 Source")
-    runcmd.run(["cmake", "."], cwd="mysql-5.5.19")
+    cache = mysql_cache()
+    if cache.get("mysql", mysql_artifact_key()) is not None:
+        log.info("MySQL %s is cached; not building it", MYSQL_VERSION)
+        return
 
-    log.info("Building MySQL 5.5.19 Source")
-    runcmd.run(["make", "-j", "4"], cwd="mysql-5.5.19")
+    stage_dir = opath.abspath("mysql-%s-stage" % MYSQL_VERSION)
 
-    log.info("Installing MySQL 5.5.19 Source to /usr/local/mysql")
-    runcmd.check_sudo(["make" ,"install"], cwd="mysql-5.5.19")
+    log.info("Configuring MySQL %s Source", MYSQL_VERSION)
+    runcmd.run(["cmake", "."] + MYSQL_CMAKE_FLAGS, cwd=MYSQL_SRC_DIR)
+
+    log.info("Building MySQL %s Source on %d cores", MYSQL_VERSION, multiprocessing.cpu_count())
+    runcmd.run(["make", "-j", str(multiprocessing.cpu_count())], cwd=MYSQL_SRC_DIR)
+    runcmd.run(["make", "install", "DESTDIR=%s" % stage_dir], cwd=MYSQL_SRC_DIR)
+
+    if not opath.isdir(cache.root):
+        os.makedirs(cache.root)
+
+    fd, tar_path = runcmd.temp_file(dir=cache.root)
+    os.close(fd)
+    runcmd.run(["tar", "czf", tar_path, "-C", stage_dir, MYSQL_PREFIX.lstrip("/")])
+
+    if not runcmd.backend().live:
+        os.remove(tar_path)
+        return
+
+    cache.put("mysql", mysql_artifact_key(), tar_path)
+
+@timeline.traced
+def install_mysql():
+    path = mysql_cache().get("mysql", mysql_artifact_key())
+    if path is None:
+        if runcmd.backend().live:
+            raise RuntimeError("MySQL %s isn't cached; run again with --force build_mysql" % MYSQL_VERSION)
+        path = mysql_cache().path("mysql", mysql_artifact_key())
+
+    log.info("Installing MySQL %s to %s from %s", MYSQL_VERSION, MYSQL_PREFIX, path)
+    runcmd.check_sudo(["tar", "xzf", path, "-C", "/"])
 
     runcmd.install_files("/etc/profile.d", ["mysql.sh"])
     runcmd.install_files("/etc/ld.so.conf.d", ["mysql-ld.so.conf"])
     runcmd.check_sudo(['ldconfig'])
 
 
+@timeline.traced
 def configure_postfix(host_name):
     main_cf = open(runcmd.rsrc_path("main.cf.in")).read() % locals()
-    open(runcmd.rsrc_path("main.cf"), "w").write(main_cf)
+    open(runcmd.output_path("main.cf"), "w").write(main_cf)
 
     main_cf = open(runcmd.rsrc_path("virtual.in")).read() % locals()
-    open(runcmd.rsrc_path("virtual"), "w").write(main_cf)
+    open(runcmd.output_path("virtual"), "w").write(main_cf)
 
-    runcmd.install_files("/etc/postfix", [runcmd.rsrc_path(f) for f in ["main.cf", "sasl_passwd", "virtual"]])
-    runcmd.install_files("/etc", [runcmd.rsrc_path("aliases")])
-    runcmd.check_sudo(["postmap", "/etc/postfix/sasl_passwd"])
-    runcmd.check_sudo(["postmap", "/etc/postfix/virtual"])
-    runcmd.check_sudo(["newaliases"])
-    runcmd.restart_service("postfix")
+    with runcmd.sudo_batch():
+        runcmd.install_files("/etc/postfix", [runcmd.output_path("main.cf"), runcmd.rsrc_path("sasl_passwd"),
+                                              runcmd.output_path("virtual")])
+        runcmd.install_files("/etc", [runcmd.rsrc_path("aliases")])
+        runcmd.check_sudo(["postmap", "/etc/postfix/sasl_passwd"])
+        runcmd.check_sudo(["postmap", "/etc/postfix/virtual"])
+        runcmd.check_sudo(["newaliases"])
+        runcmd.restart_service("postfix")
 
 raid_phys_devs = [("/dev/sd%s" % d) for d in ("hijk")]
+def wait_for_devices(devices, timeout=600):
+    """Waits until the block devices `devices` exist."""
+
+    if not runcmd.backend().live:
+        return
+
+    log.info("Waiting for devices %s", ", ".join(devices))
+    runcmd.wait(lambda: all(opath.exists(d) for d in devices), timeout=timeout)
+
+def db_storage_plan(devices):
+    """Returns the layout of the database storage on `devices`, sized
+    from the devices when they are attached."""
+
+    return storage.StoragePlan(devices, sizes_gb=storage.device_sizes_gb(devices),
+                               volume_group="mysql", volume="mysql", mount_point="/mysql")
+
+@timeline.traced
 def configure_db_raid():
-    p = raid_phys_devs[::2]
-    n = raid_phys_devs[1::2]
-
-    log.info("Creating RAID0 arrays")
-    raid_devs = []
-    for i, (a, b) in itt.izip(itt.count(20), itt.izip(p, n)):
-        r = "/dev/md%d" % i
-        runcmd.check_sudo(["mdadm", "--create", "--level=0", "--raid-devices=2", r, a, b])
-        raid_devs.append(r)
-
-    log.info("Creating RAID1 array")
-    runcmd.check_sudo(["mdadm", "--create", "--force", "--level=1", "--raid-devices=%d" % len(raid_devs),
-                "/dev/md0"] + raid_devs)
-
-    log.info("Creating MySQL Logical Volume")
-    runcmd.check_sudo(["pvcreate", "/dev/md0"])
-    runcmd.check_sudo(["vgcreate", "mysql", "/dev/md0"])
-    runcmd.check_sudo(["lvcreate", "-nmysql", "-l75%FREE", "mysql"])
-    runcmd.check_sudo(["mkfs.ext4", "/dev/mysql/mysql"])
+    wait_for_devices(raid_phys_devs)
+
+    plan = db_storage_plan(raid_phys_devs)
+    log.info("Laying out database storage: %s", plan.describe())
+
+    with runcmd.sudo_batch():
+        for cmd in plan.commands():
+            runcmd.check_sudo(cmd)
+
+    rules_path = runcmd.output_path("60-mysql-readahead.rules")
+    fstab_path = runcmd.output_path("fstab")
+    with open(rules_path, "w") as rules_out:
+        rules_out.write("\n".join(plan.udev_rules()) + "\n")
 
     with open("/etc/fstab") as fstab_in:
-        with open(runcmd.rsrc_path("fstab"), "w") as fstab_out:
+        with open(fstab_path, "w") as fstab_out:
             fstab_out.write(fstab_in.read())
             fstab_out.write("\n")
-            fstab_out.write("\t".join(("/dev/mysql/mysql", "/mysql", "ext4", "nodev,nosuid", "0", "0")))
+            fstab_out.write(plan.fstab_line())
             fstab_out.write("\n")
 
-    runcmd.install_files("/etc", ["fstab"])
+    runcmd.install_files("/etc/udev/rules.d", [rules_path])
+    runcmd.install_files("/etc", [fstab_path])
     create_mysql_user_fs()
 
 def create_mysql_user_fs():
-    runcmd.check_sudo(["mkdir", "/mysql"])
-    runcmd.check_sudo(["mount", "/mysql"])
+    with runcmd.sudo_batch():
+        runcmd.check_sudo(["mkdir", "/mysql"])
+        runcmd.check_sudo(["mount", "/mysql"])
 
-    runcmd.check_sudo(["mkdir", "-p", "/mysql/log", "/mysql/binlog", "/mysql/data"])
-    runcmd.check_sudo(["groupadd", "mysql"])
-    runcmd.check_sudo(["useradd", "-g", "mysql", "-G", "admin", "-s", "/bin/bash", "-d", "/mysql", "mysql"])
-    runcmd.check_sudo(["chown", "-R", "mysql:mysql", "/mysql"])
+        runcmd.check_sudo(["mkdir", "-p", "/mysql/log", "/mysql/binlog", "/mysql/data"])
+        runcmd.check_sudo(["groupadd", "mysql"])
+        runcmd.check_sudo(["useradd", "-g", "mysql", "-G", "admin", "-s", "/bin/bash", "-d", "/mysql", "mysql"])
+        runcmd.check_sudo(["chown", "-R", "mysql:mysql", "/mysql"])
 
+@timeline.traced
 def mysql_install_db():
     runcmd.run_as_user(["/usr/local/mysql/scripts/mysql_install_db", 
                  "--basedir=/usr/local/mysql", 
@@ -164,67 +251,104 @@ def mysql_install_db():
                 user="mysql")
     runcmd.start_service("mysql5.5")
 
+@timeline.traced
 def mysql_secure_db():
-    with open(runcmd.rsrc_path("mysql_securedb.sql.in")) as sql_in:
-        with open(runcmd.rsrc_path("mysql_secure_db.sql"), "w") as sql_out:
-            sql_out.write(sql_in.read())
-
-    with open(runcmd.rsrc_path("mysql_secure_db.sql")) as sql_cmd:
+    sql_path = runcmd.output_path("mysql_secure_db.sql")
+    with open(sql_path, "w") as sql_out:
+        # Offline runs only need the command, not the SQL it is fed.
+        if runcmd.backend().live:
+            with open(runcmd.rsrc_path("mysql_securedb.sql.in")) as sql_in:
+                sql_out.write(sql_in.read())
+
+    with open(sql_path) as sql_cmd:
         runcmd.run(["/usr/local/mysql/bin/mysql", "--user=root", "--batch"], 
                    stdin=sql_cmd)
 
+@timeline.traced
 def set_host_name(host_name):
     log.info("Setting host name in /etc/hosts to %s", host_name)
 
+    hosts_path = runcmd.output_path("hosts")
+    hostname_path = runcmd.output_path("hostname")
     with open("/etc/hosts") as hosts_in:
-        with open(runcmd.rsrc_path("hosts"), "w") as hosts_out:
+        with open(hosts_path, "w") as hosts_out:
             hosts_out.write(hosts_in.read())
             hosts_out.write("\n127.0.1.2\t%(host_name)s.memrise.com %(host_name)s\n" % locals())
 
-    runcmd.install_files("/etc", [runcmd.rsrc_path("hosts")])
-
-    with open(runcmd.rsrc_path("hostname"), "w") as hn:
+    with open(hostname_path, "w") as hn:
         hn.write("%s\n" % host_name)
 
-    runcmd.install_files("/etc", [runcmd.rsrc_path("hostname")])
-
-    runcmd.check_sudo(["hostname", host_name])
-
-def all_hosts(host_name):
-    set_host_name(host_name)
-    generate_root_ssh_key()
-    create_memrise_user()
-    upgrade_install_packages()
-    configure_ssh()
-    configure_postfix(host_name)
-    install_mysql()
-
-def mysql_server():
-    install_my_cnf(55)
-    configure_db_raid()
-    mysql_install_db()
-    mysql_secure_db()
-
-def install_my_cnf(buffer_pool_size_gb):
-    with open("my.cnf.in") as my_cnf_in:
-        with open("my.cnf", "w") as my_cnf_out:
-            my_cnf_out.write(my_cnf_in.read() % locals())
-
-    runcmd.install_files("/etc/init", ["mysql5.5.conf"])
-    runcmd.install_dirs(["/etc/mysql"])
-    runcmd.install_files("/etc/mysql", ["my.cnf"])
-
-def default_server():
+    with runcmd.sudo_batch():
+        runcmd.install_files("/etc", [hosts_path])
+        runcmd.install_files("/etc", [hostname_path])
+        runcmd.check_sudo(["hostname", host_name])
+
+def all_hosts(host_name, plan):
+    plan.add("set_host_name", set_host_name, host_name, locks=["etc"])
+    plan.add("generate_root_ssh_key", generate_root_ssh_key)
+    plan.add("create_memrise_user", create_memrise_user, locks=["etc"])
+    plan.add("generate_memrise_ssh_key", generate_memrise_ssh_key, deps=["create_memrise_user"])
+    # Package installs write to /etc too (conffiles, adduser in postinst
+    # scripts, sshd_config), so apt steps also hold the /etc lock.
+    plan.add("upgrade_install_packages", upgrade_install_packages, locks=["apt", "etc"])
+    # An openssh-server upgrade would replace our sshd_config.
+    plan.add("configure_ssh", configure_ssh, deps=["upgrade_install_packages"], locks=["etc"])
+    plan.add("configure_postfix", configure_postfix, host_name,
+             deps=["set_host_name", "upgrade_install_packages"], locks=["etc"])
+    plan.add("download_mysql", download_mysql)
+    plan.add("build_mysql", build_mysql, deps=["download_mysql", "upgrade_install_packages"])
+    plan.add("install_mysql", install_mysql, deps=["build_mysql"], locks=["etc"])
+
+def mysql_server(plan):
+    plan.add("install_my_cnf", install_my_cnf, mycnf.host_profiles["mysql"], raid_phys_devs, locks=["etc"])
+    plan.add("configure_db_raid", configure_db_raid, deps=["upgrade_install_packages"], locks=["etc"])
+    plan.add("mysql_install_db", mysql_install_db,
+             deps=["install_mysql", "install_my_cnf", "configure_db_raid"])
+    plan.add("mysql_secure_db", mysql_secure_db, deps=["mysql_install_db"])
+
+@timeline.traced
+def install_my_cnf(profile, devices=()):
+    """Installs my.cnf sized for this instance, with MySQL getting the
+    share of it given by `profile` (see mycnf.profiles) and its data on
+    an array of `devices`, if any."""
+
+    # Offline runs can't read the instance metadata.
+    instance_type = mycnf.local_instance_type(default=None if runcmd.backend().live else "m1.large")
+    layout = db_storage_plan(devices) if devices else None
+    values = mycnf.settings(mycnf.instance_spec(instance_type, local=runcmd.backend().live), mycnf.profiles[profile],
+                            layout)
+
+    log.info("MySQL settings for %s (%s profile):", instance_type, profile)
+    for line in mycnf.describe(values):
+        log.info("  %s", line)
+
+    my_cnf_path = runcmd.output_path("my.cnf")
+    with open(runcmd.rsrc_path("my.cnf.in")) as my_cnf_in:
+        with open(my_cnf_path, "w") as my_cnf_out:
+            my_cnf_out.write(mycnf.render(my_cnf_in.read(), values))
+
+    with runcmd.sudo_batch():
+        runcmd.install_files("/etc/init", ["mysql5.5.conf"])
+        runcmd.install_dirs(["/etc/mysql"])
+        runcmd.install_files("/etc/mysql", [my_cnf_path])
+
+def default_server(plan):
     pass
 
-def rabbitmq_server():
-    runcmd.apt_get(["install", "rabbitmq-server"])
-    runcmd.check_sudo(["rabbitmqctl", "add_user", "memrise", "ktbyunvfy"])
-    runcmd.check_sudo(["rabbitmqctl", "add_vhost", "/memrise"])
-    runcmd.check_sudo(["rabbitmqctl", "set_permissions", "-p", "/memrise", "memrise", "", ".*", ".*"])
-    runcmd.check_sudo(["rabbitmqctl", "delete_user", "guest"])
+@timeline.traced
+def configure_rabbitmq():
+    with runcmd.sudo_batch():
+        runcmd.apt_get(["install", "rabbitmq-server"])
+        runcmd.check_sudo(["rabbitmqctl", "add_user", "memrise", "ktbyunvfy"])
+        runcmd.check_sudo(["rabbitmqctl", "add_vhost", "/memrise"])
+        runcmd.check_sudo(["rabbitmqctl", "set_permissions", "-p", "/memrise", "memrise", "", ".*", ".*"])
+        runcmd.check_sudo(["rabbitmqctl", "delete_user", "guest"])
 
-def jenkins_server():
+def rabbitmq_server(plan):
+    plan.add("configure_rabbitmq", configure_rabbitmq, deps=["upgrade_install_packages"], locks=["apt", "etc"])
+
+@timeline.traced
+def install_jenkins():
     runcmd.run(["wget", "-O", "jenkins-ci.org.key", "http://pkg.jenkins-ci.org/debian/jenkins-ci.org.key"])
     runcmd.check_sudo(["apt-key", "add", "jenkins-ci.org.key"])
     runcmd.install_files("/etc/apt/sources.list.d", ["jenkins.list"])
@@ -232,39 +356,85 @@ def jenkins_server():
     runcmd.apt_get(["install", "openjdk-6-jdk", "jenkins", "libcobertura-java"])
     runcmd.install_files("/etc/default", ["jenkins"])
 
-def staging_server():
+def jenkins_server(plan):
+    plan.add("install_jenkins", install_jenkins, deps=["upgrade_install_packages"], locks=["apt", "etc"])
+
+@timeline.traced
+def move_mnt_to_mysql():
     runcmd.install_files("/etc/init", ["mysql5.5.conf"])
 
+    fstab_path = runcmd.output_path("fstab")
     with open("/etc/fstab") as fstab_in:
-        with open("fstab", "w") as fstab_out:
+        with open(fstab_path, "w") as fstab_out:
             for l in fstab_in:
                 fstab_out.write(l.replace("/mnt", "/mysql"))
 
-    runcmd.install_files("/etc", ["fstab"])
+    runcmd.install_files("/etc", [fstab_path])
 
     runcmd.check_sudo(["umount", "/mnt"])
 
-    create_mysql_user_fs()
-    install_my_cnf(1)
-    mysql_install_db()
-    mysql_secure_db()
+def staging_server(plan, profile=mycnf.host_profiles["staging"]):
+    plan.add("move_mnt_to_mysql", move_mnt_to_mysql, locks=["etc"])
+    plan.add("create_mysql_user_fs", create_mysql_user_fs, deps=["move_mnt_to_mysql"], locks=["etc"])
+    plan.add("install_my_cnf", install_my_cnf, profile, locks=["etc"])
+    plan.add("mysql_install_db", mysql_install_db,
+             deps=["install_mysql", "install_my_cnf", "create_mysql_user_fs"])
+    plan.add("mysql_secure_db", mysql_secure_db, deps=["mysql_install_db"])
+
+def backupdb_server(plan):
+    staging_server(plan, mycnf.host_profiles["backupdb"])
 
+# Steps that depend on the particular host (its name, keys, instance
+# type or attached volumes), and so are left out of baked images; see
+# bake_ami.
+per_host_steps = ["set_host_name", "generate_root_ssh_key", "generate_memrise_ssh_key", "configure_postfix",
+                  "install_my_cnf", "configure_db_raid", "move_mnt_to_mysql"]
 
 host_type_map = {"mysql": mysql_server,
                  "web": default_server,
                  "celery": default_server,
                  "rabbitmq": rabbitmq_server,
                  "jenkins": jenkins_server,
-                 "backupdb": staging_server,
+                 "backupdb": backupdb_server,
                  "staging": staging_server}
 
 if __name__ == "__main__":
-    host_type = sys.argv[1]
-    host_name = sys.argv[2]
-
-    log.info("Setting up host type %s with host name %s", host_type, host_name)
-
-    host_type = host_type_map[host_type]
-
-    all_hosts(host_name)
-    host_type()
+    parser = argparse.ArgumentParser(description="Configure this host. Steps that already completed are skipped.")
+    parser.add_argument("host_type", choices=sorted(host_type_map))
+    parser.add_argument("host_name")
+    parser.add_argument("--force", action="append", default=[], metavar="STEP",
+                        help="run STEP even if the journal says it is done (repeatable)")
+    parser.add_argument("--no-journal", action="store_true", help="run every step and record nothing")
+    parser.add_argument("--bake", action="store_true",
+                        help="run only the steps that go into a baked image, leaving out per-host steps")
+    parser.add_argument("--workers", type=int, default=4, help="steps to run at once (default: %(default)s)")
+    parser.add_argument("--backend", metavar="SPEC",
+                        help="run commands with a backend: local, dry-run, record:PATH or replay:PATH[:SPEED]")
+    args = parser.parse_args()
+
+    if args.backend is not None:
+        runcmd.set_backend(runcmd.backend_from_spec(args.backend))
+
+    log.info("Setting up host type %s with host name %s", args.host_type, args.host_name)
+
+    host_type = host_type_map[args.host_type]
+
+    # Offline runs mustn't mark steps done in the real journal.
+    if args.no_journal or not runcmd.backend().live:
+        completed = journal.NullJournal()
+    else:
+        completed = journal.Journal(force=args.force)
+
+    plan = steps.Plan()
+    all_hosts(args.host_name, plan)
+    host_type(plan)
+    if args.bake:
+        plan = plan.without(per_host_steps)
+        log.info("Baking steps: %s", ", ".join(s.name for s in plan.steps))
+
+    start = time.time()
+    try:
+        plan.run(completed, workers=args.workers)
+    finally:
+        plan.report()
+    log.info("Set up %s as %s in %.1fs", args.host_name, args.host_type, time.time() - start)
\ No newline at end of file
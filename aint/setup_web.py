@@ -9,7 +9,12 @@ import traceback as tb
 import socket
 import itertools as itt
 import os
+import artifacts
+import gitcache
 import runcmd as rc
+import wheelhouse
+import hostkeys
+import timeline
 import subprocess as subp
 
 logging.basicConfig(level=logging.INFO)
@@ -24,9 +29,9 @@ except:
 
 os.environ["PATH"] = opath.pathsep.join((["/usr/local/mysql/bin"] + list(os.environ["PATH"].split(opath.pathsep))))
 
+@timeline.traced
 def checkout_etc():
-    with open(rc.rsrc_path("known_hosts")) as known_hosts:
-        rc.check_sudo(["/bin/bash", "-c", "cat >> /root/.ssh/known_hosts"], stdin=known_hosts)
+    rc.check_sudo(["python", rc.rsrc_path("hostkeys.py"), "/root/.ssh/known_hosts", rc.rsrc_path("known_hosts")])
 
     if opath.isdir("/etc/.git"):
         log.warn("/etc .git exists, cowardly skipping creating it")
@@ -39,6 +44,13 @@ def checkout_etc():
     rc.check_sudo(["git", "remote", "add", "origin", settings.etc_repo_uri],
                   cwd="/etc")
 
+    # Start from the bundle this host was sent, so fetching from the
+    # remote only brings in what is newer.
+    bundle = gitcache.local_bundle("etc")
+    if bundle is not None:
+        log.info("Fetching /etc repository from %s", bundle)
+        rc.check_sudo(["git", "fetch", bundle, "master:refs/remotes/origin/master"], cwd="/etc")
+
     log.info("Fetching /etc repository from %s", settings.etc_repo_uri)
     rc.check_sudo(["git", "fetch"], cwd="/etc")
     rc.check_sudo(["git", "branch", "master", "origin/master"], cwd="/etc")
@@ -51,6 +63,7 @@ def checkout_etc():
 
     log.info("/etc updated from repository")
 
+@timeline.traced
 def enable_site():
     log.info("Enabling web site %s", settings.site_config_name)
 
@@ -68,44 +81,57 @@ def enable_site():
 
     log.info("Enabled web site %s", settings.site_config_name)
 
+@timeline.traced
 def checkout_site():
     setup_known_hosts()
 
     if not opath.exists(opath.expanduser("~/memrise")):
         os.mkdir(opath.expanduser("~/memrise"))
 
-    log.info("Checking out memrise site from unfuddle")
+    bundle = gitcache.local_bundle("site")
+    if bundle is None:
+        log.info("Checking out memrise site from unfuddle")
+        rc.run(["git", "clone", settings.site_repo_uri, "memrise"], cwd=opath.expanduser("~/memrise"))
+        return
 
-    rc.run(["git", "clone", "git@memrise.unfuddle.com:memrise/memrise-django.git", "memrise"],
-           cwd=opath.expanduser("~/memrise"))
+    log.info("Checking out memrise site from %s, then updating it from unfuddle", bundle)
+    rc.run(["git", "clone", "-b", "master", bundle, "memrise"], cwd=opath.expanduser("~/memrise"))
+    rc.run(["git", "remote", "set-url", "origin", settings.site_repo_uri], cwd=opath.expanduser("~/memrise/memrise"))
+    rc.run(["git", "pull", "--ff-only", "origin", "master"], cwd=opath.expanduser("~/memrise/memrise"))
 
 def setup_known_hosts():
     log.info("Adding memrise.unfuddle.com and github.com to known_hosts")
 
-    with open(opath.expanduser("~/.ssh/known_hosts"), "a") as akeys_out:
-        with open(rc.rsrc_path("known_hosts")) as akeys_in:
-            akeys_out.write("\n" + akeys_in.read() + "\n")
+    known_hosts = hostkeys.KnownHosts()
+    known_hosts.merge(rc.rsrc_path("known_hosts"))
+    known_hosts.save()
 
+@timeline.traced
 def setup_venv():
-    rc.run(["pip", "install", "-E", "../venv", "-r", "requirements.txt"], 
-           cwd=opath.expanduser("~/memrise/memrise"))
+    cache = artifacts.ArtifactCache(opath.expanduser("~/" + artifacts.remote_dir))
+    wheelhouse.install(opath.expanduser("~/memrise/memrise/requirements.txt"),
+                       opath.expanduser("~/memrise/venv"), cache)
     os.chmod('/home/memrise/memrise/', 0755)
     os.chmod('/home/memrise/', 0755)
 
+@timeline.traced
 def setup_server():
     checkout_etc()
     enable_site()
 
+@timeline.traced
 def setup_site():
     checkout_site()
     setup_venv()
 
+@timeline.traced
 def setup_bashrc():
     with open(rc.rsrc_path("bashrc.in")) as brc_in:
         with open(opath.expanduser("~/.bashrc"), "a") as brc_out:
             brc_out.write("\n")
             brc_out.write(brc_in.read())
 
+@timeline.traced
 def show_ssh_keys():
     for user in ("root", "memrise"):
         key_path = opath.expanduser("~%s/.ssh/id_rsa" % user)
@@ -113,8 +139,22 @@ def show_ssh_keys():
         rc.check_sudo(["-u", user, "-H", "cat", key_path + ".pub"])
         print
 
+@timeline.traced
 def copy_to_memrise():
     log.info("Copying setup_ec2 to memrise home")
+
+    # Unpack the provisioning bundle this host was sent, if there is one.
+    bundle_hash = opath.expanduser("~/setup_ec2/.bundle")
+    if opath.exists(bundle_hash):
+        with open(bundle_hash) as hash_in:
+            bundle_path = opath.expanduser("~/setup_ec2/.bundles/%s.tar.gz" % hash_in.read().strip())
+
+        rc.run_as_user(["mkdir", "-p", opath.expanduser("~memrise/setup_ec2")], user="memrise")
+        with open(bundle_path, "rb") as bundle_in:
+            rc.run_as_user(["tar", "xz", "-C", opath.expanduser("~memrise/setup_ec2")], user="memrise", stdin=bundle_in)
+        copy_caches_to_memrise()
+        return
+
     src = subp.Popen(["tar", "c", "-C", opath.expanduser("~"), "setup_ec2"], stdout=subp.PIPE)
     tgt = subp.Popen(["sudo", "-u", "memrise", "tar", "x", "-C", opath.expanduser("~memrise")], stdin=src.stdout)
 
@@ -124,6 +164,19 @@ def copy_to_memrise():
     if src_stat or tgt_stat:
         raise Exception("Copying setup_ec2 to memrise user failed: src: %d, tgt: %d" % (src_stat, tgt_stat))
 
+def copy_caches_to_memrise():
+    """Gives memrise its own copy of the artifact cache and git bundles,
+    for setup_venv and checkout_site."""
+
+    for cache_dir in (artifacts.remote_dir, gitcache.remote_dir):
+        src = opath.expanduser("~/" + cache_dir)
+        dest = opath.expanduser("~memrise/" + cache_dir)
+
+        rc.run_as_user(["mkdir", "-p", dest], user="memrise")
+        if opath.isdir(src):
+            rc.run_as_user(["cp", "-r", src + "/.", dest], user="memrise")
+
+@timeline.traced
 def setup_web():
     setup_server()
     copy_to_memrise()
@@ -131,21 +184,25 @@ def setup_web():
 
     rc.run_as_user(["python", "setup_web.py", "memrise-web"], user="memrise", path="~memrise/setup_ec2/aws")
 
+@timeline.traced
 def setup_web_as_memrise():
     checkout_site()
     setup_venv()
     setup_bashrc()
 
+@timeline.traced
 def setup_jenkins():
     rc.install_dirs(["~memrise/log/jenkins"], owner="memrise", group="memrise", mode="0750")
     copy_to_memrise()
     rc.run_as_user(["python", "setup_web.py", "memrise-jenkins"], user="memrise", path="~memrise/setup_ec2/aws")
     rc.restart_service("jenkins")
 
+@timeline.traced
 def setup_jenkins_as_memrise():
     setup_known_hosts()
     rc.run(["git", "clone", "git@github.com:Memrise/jenkins.git"], cwd=opath.expanduser("~"))
 
+@timeline.traced
 def setup_celery():
     checkout_etc()
 
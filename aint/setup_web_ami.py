@@ -15,7 +15,11 @@ logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("setup_web_ami")
 
 def run_instances(ec2, count, ami=WEB_AMI, instance_type=WEB_INSTANCE):
-    """Runs `count` instances using the web AMI."""
+    """Runs `count` instances using the web AMI.
+
+    The hand-made web AMI is a complete web server. Images baked by
+    bake_ami still need their per-host steps, which only
+    start_instance runs, so they aren't used here."""
 
     log.info("Requesting %d instances using AMI %s", count, ami)
 
@@ -27,50 +31,55 @@ def run_instances(ec2, count, ami=WEB_AMI, instance_type=WEB_INSTANCE):
                             max_count=count)
 
     instances = res.instances
-    aint.wait(lambda: aint.all_started(ec2, instances))
+    aint.wait_for_state(ec2, instances, "running")
 
     return aint.reservation_instances(ec2, res)
 
         
 web_re = re.compile("web([0-9]+)")
 def next_web_server(ec2):
-    names = (aint.name(i) for i in aint.walk_instances(ec2) if aint.is_web(i) and not aint.is_terminated(i))
+    names = (aint.name(i) for i in aint.query_instances(ec2, instance_type="web", state=aint.live_states))
 
     return sorted(int(web_re.split(n)[1]) for n in names)[-1] + 1
 
-def set_instance_metadata(ec2, instance):
-    name = "web%d" % next_web_server(ec2)
+def set_instance_metadata(instance, name):
     instance.add_tag("instance_type", "web")
     instance.add_tag("Name", name)
 
-def set_instance_dns_name(rrs, instance):
-    dns_name = aint.memrise_hostname(instance) + "."
+def set_instance_dns_name(zone, instance):
+    dns_name = aint.hostname(instance) + "."
     aws_name = aint.aws_hostname(instance) + "."
 
-    sdns.replace_rr(rrs, dns_name, "CNAME", [aws_name])
+    zone.want(dns_name, "CNAME", [aws_name])
 
 def sync_web_dns():
     ec2 = aint.connect()
     r53 = sdns.connect()
-    rrs = sdns.current_rrs(r53)
+    zone = sdns.ZoneSync(r53)
 
-    for instance in (i for i in aint.walk_instances(ec2) 
-                     if aint.is_running(i) and aint.is_web(i)):
+    for instance in aint.query_instances(ec2, instance_type="web", state="running"):
         print aint.name(instance), aint.aws_hostname(instance)
-        set_instance_dns_name(rrs, instance)
+        set_instance_dns_name(zone, instance)
+
+    dns = sdns.ChangeTracker(r53)
+    dns.track(zone.commit())
+    print "%d records already up to date" % len(zone.unchanged)
 
-    rrs.commit()
+    dns.wait()
 
 def main():
     ec2 = aint.connect()
     r53 = sdns.connect()
-    rrs = sdns.current_rrs(r53)
+    zone = sdns.ZoneSync(r53)
     instances = run_instances(ec2, 4)
+    first = next_web_server(ec2)
 
-    for i in instances:
-        set_instance_metadata(ec2, i)
-        set_instance_dns_name(rrs, i)
+    for n, i in enumerate(instances):
+        set_instance_metadata(i, "web%d" % (first + n))
+        set_instance_dns_name(zone, i)
 
-        print i.id, aint.memrise_hostname(i), aint.aws_hostname(i)
+        print i.id, aint.hostname(i), aint.aws_hostname(i)
 
-    rrs.commit()
+    dns = sdns.ChangeTracker(r53)
+    dns.track(zone.commit())
+    dns.wait()
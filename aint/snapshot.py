@@ -0,0 +1,116 @@
+"""Compact on-disk snapshot of the instance inventory, so read-only
+commands don't have to sweep the account on every run."""
+
+import argparse
+import json
+import logging
+import os
+import os.path as opath
+import tempfile as tempf
+import time
+
+import instances as aint
+
+log = logging.getLogger("snapshot")
+
+# Where the snapshot lives, and how old (in seconds) it may be before
+# read-only commands sweep the account again.
+snapshot_path = opath.expanduser("~/.aint/inventory.json")
+max_age = 300
+
+class InstanceRecord(object):
+    """The parts of a boto Instance that aint actually uses.
+
+    Records work with the predicates in `aint.instances` (`is_web`,
+    `is_running`, `name`, `aws_hostname`...)."""
+
+    __slots__ = ("id", "state", "tags", "public_dns_name", "placement")
+
+    def __init__(self, id, state, tags, public_dns_name, placement):
+        self.id = id
+        self.state = state
+        self.tags = tags
+        self.public_dns_name = public_dns_name
+        self.placement = placement
+
+    @classmethod
+    def from_instance(cls, instance):
+        return cls(instance.id, instance.state, dict(instance.tags),
+                   instance.public_dns_name, instance.placement)
+
+    def as_list(self):
+        return [getattr(self, f) for f in self.__slots__]
+
+    def __repr__(self):
+        return "InstanceRecord(%s)" % self.id
+
+def save(records, path=snapshot_path):
+    """Atomically writes `records` to the snapshot file at `path`."""
+
+    dir_name = opath.dirname(path)
+    if not opath.isdir(dir_name):
+        os.makedirs(dir_name)
+
+    fd, tmp_path = tempf.mkstemp(dir=dir_name)
+    with os.fdopen(fd, "w") as out:
+        json.dump({"taken_at": time.time(), "instances": [r.as_list() for r in records]}, out)
+
+    os.rename(tmp_path, path)
+
+def load(path=snapshot_path, max_age=max_age):
+    """Returns the records in the snapshot at `path`, or `None` if there
+    is no snapshot or it is more than `max_age` seconds old."""
+
+    try:
+        with open(path) as snap_in:
+            snap = json.load(snap_in)
+    except (IOError, ValueError):
+        return None
+
+    if time.time() - snap["taken_at"] > max_age:
+        return None
+
+    return [InstanceRecord(*r) for r in snap["instances"]]
+
+def invalidate(path=snapshot_path):
+    """Discards the snapshot at `path`, after instances changed state."""
+
+    if opath.exists(path):
+        os.remove(path)
+
+def records(ec2=None, refresh=False, path=snapshot_path, max_age=max_age):
+    """Returns the instance records from the snapshot, sweeping the
+    account and rewriting the snapshot if it is stale or `refresh` is
+    set."""
+
+    recs = None if refresh else load(path, max_age)
+    if recs is not None:
+        return recs
+
+    log.info("Refreshing instance snapshot %s", path)
+    recs = [InstanceRecord.from_instance(i) for i in aint.walk_instances(ec2 or aint.connect())]
+    save(recs, path)
+
+    return recs
+
+def main():
+    """
+    e.g. list_instances --type web --state running
+    """
+    parser = argparse.ArgumentParser(description="List instances from the local inventory snapshot.")
+    parser.add_argument("--type", help="only instances with this instance_type tag")
+    parser.add_argument("--state", help="only instances in this state")
+    parser.add_argument("--deployable", action="store_true", help="only instances that deploys go to")
+    parser.add_argument("--refresh", action="store_true", help="sweep the account even if the snapshot is fresh")
+    parser.add_argument("--max-age", type=int, default=max_age, help="maximum snapshot age in seconds")
+    args = parser.parse_args()
+
+    for rec in records(refresh=args.refresh, max_age=args.max_age):
+        if args.type is not None and not aint.is_type(rec, args.type):
+            continue
+        if args.state is not None and rec.state != args.state:
+            continue
+        if args.deployable and not aint.should_deploy(rec):
+            continue
+
+        print("\t".join((rec.tags.get(u"Name", "-"), rec.id, rec.state, rec.public_dns_name or "-")))
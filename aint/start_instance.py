@@ -11,9 +11,26 @@ import os.path as opath
 import socket
 import logging
 import itertools as itt
+import re
+import argparse
+import tempfile as tempf
+import threading
 import adns as adns
+import amis
+import artifacts
+import bundle
+import ebs
+import ec2types
+import gitcache
+import hostkeys
+import instances as aint
+import remote
+import timeline
+import waiter as wt
 import aws.runcmd as rc
 
+from multiprocessing.pool import ThreadPool
+
 import settings as awssett
 
 logging.basicConfig(level=logging.INFO)
@@ -24,13 +41,7 @@ log = logging.getLogger("initialize_instance")
 # bit) (since the smaller instance sizes have to be 32-bit)
 ami_32bit = "ami-ab36fbc2"
 ami_64bit = "ami-ad36fbc4"
-instance_ami_map = {
-    "m1.xlarge": ami_64bit,
-    "m2.4xlarge": ami_64bit,
-    "m1.large": ami_64bit,
-    "c1.medium": ami_32bit,
-    "m1.small": ami_32bit,
-    }
+instance_ami_map = dict((name, ami_64bit if t.bits == 64 else ami_32bit) for name, t in ec2types.types.items())
 
 # EC2 instance types for the different server types.
 instance_types = {
@@ -44,148 +55,380 @@ instance_types = {
 
 aws_pem = opath.expanduser(awssett.ssh_key_path)
 
-def start_instance(ec2, instance_type=instance_types["default"]):
-    ami = instance_ami_map[instance_type]
+def start_instances(ec2, instance_type=instance_types["default"], count=1, storage=False, ami=None, timeout=600):
+    """Starts `count` instances of `ami` (by default, the stock image
+    for `instance_type`) in a single request and waits for all of them
+    to run. With `storage`, each instance also gets a set of database
+    volumes, created while it boots and attached as soon as both are
+    ready; see `database_storage`. Raises `waiter.WaitTimeout` if an
+    instance or volume isn't ready within `timeout` seconds."""
 
-    log.info("Requesting AMI %s for instance type %s", ami, instance_type)
+    ami = ami or instance_ami_map[instance_type]
+
+    log.info("Requesting %d instances of AMI %s for instance type %s", count, ami, instance_type)
     # RES = reservation handle, a group of instances
-    # including the one we just started (since you can start many at a time)
+    # including the ones we just started (since you can start many at a time)
     res = ec2.run_instances(ami, instance_type=instance_type, 
                             placement='us-east-1d', 
-                            key_name='memrise')
+                            key_name='memrise',
+                            min_count=count,
+                            max_count=count)
 
-    res_id = res.id
-    instance = res.instances[0]
+    instances = res.instances
+    waiter = wt.Waiter()
 
-    log.info("Waiting for instance %s to start", instance.id)
+    if storage:
+        for instance in instances:
+            database_storage[instance.id] = create_database_storage(ec2)
+            database_storage[instance.id].attach_when_ready(instance, waiter, timeout)
 
-    def is_running():
-        instance.update()
-        return instance.state == "running"
+    log.info("Waiting for instances %s to start", ", ".join(i.id for i in instances))
 
-    rc.wait(is_running)
+    def started(instance):
+        log.info("Instance %s started", instance.id)
+        log.info("Connect using host name %s", instance.public_dns_name)
 
-    log.info("Instance %s started", instance.id)
-    log.info("Connect using host name %s", instance.public_dns_name)
+    aint.wait_for_state(ec2, instances, "running", on_met=started, timeout=timeout, waiter=waiter)
+    waiter.run()
 
-    return instance
+    return instances
 
-def remove_stale_host_keys(instance):
+def start_instance(ec2, instance_type=instance_types["default"]):
+    return start_instances(ec2, instance_type)[0]
+
+def remove_stale_host_keys(instances):
     """Remove the stale SSH host keys from known_hosts to avoid key errors."""
 
     log.info("Removing stale ssh host keys")
-    subp.call(["ssh-keygen", "-f", opath.expanduser("~/.ssh/known_hosts"), "-R", instance.public_dns_name], 
-              stderr=open("/dev/null", "w"))
 
-    addrs = set()
-    for p, q, r, s, (addr, port) in socket.getaddrinfo(instance.public_dns_name, 0):
-        if addr in addrs:
-            continue
+    hosts = set()
+    for instance in instances:
+        hosts.add(instance.public_dns_name)
+        for p, q, r, s, sockaddr in socket.getaddrinfo(instance.public_dns_name, 0):
+            hosts.add(sockaddr[0])
+
+    # sshd moves to port 2000 once configure_ssh has run.
+    hosts |= set(hostkeys.host_pattern(h, 2000) for h in hosts)
+
+    known_hosts = hostkeys.KnownHosts()
+    known_hosts.remove(sorted(hosts))
+    known_hosts.save()
+
+def wait_for_ssh(instances, waiter, on_ready, on_timeout=None, timeout=600, port=22):
+    """Adds conditions to `waiter` that call `on_ready(instance)` as
+    soon as ssh works on each of `instances`.
 
-        subp.call(["ssh-keygen", "-f", opath.expanduser("~/.ssh/known_hosts"), "-R", addr])
-        addrs.add(addr)
+    Each poll probes every pending host's ssh port at once, and only
+    hosts whose port answers are tried with an authenticated ssh. A
+    host that fails for good gets `on_timeout(instance)` too, so one
+    host doesn't lose the others' results."""
 
-def wait_for_ssh(instance):
-    """Wait for SSH to start on the new instance."""
+    answering = set()
 
-    user_host = "ubuntu@%s" % instance.public_dns_name
+    def probe():
+        hosts = [i.public_dns_name for i in instances if i.public_dns_name not in answering]
+        if hosts:
+            answering.update(remote.probe_ssh(hosts, port))
 
-    log.info("Waiting for ssh to start on %s", instance.public_dns_name)
+    waiter.add_hook(probe)
 
-    rc.wait(lambda: subp.call(["ssh", "-i", aws_pem, user_host, "true"]))
+    for instance in instances:
+        log.info("Waiting for ssh to start on %s", instance.public_dns_name)
+
+        waiter.add(lambda instance=instance: (instance.public_dns_name in answering and
+                                              session(instance).call("true") == 0),
+                   on_met=lambda instance=instance: on_ready(instance),
+                   on_timeout=(lambda instance=instance: on_timeout(instance)) if on_timeout is not None else None,
+                   on_fail=(lambda e, instance=instance: on_timeout(instance)) if on_timeout is not None else None,
+                   timeout=timeout,
+                   name="ssh on %s" % instance.public_dns_name)
+
+_dns_changes = None
+def dns_changes():
+    """Returns the tracker for the DNS changes made by this run."""
+
+    global _dns_changes
+
+    if _dns_changes is None:
+        _dns_changes = adns.ChangeTracker(adns.connect())
+
+    return _dns_changes
 
 def set_dns_cname(instance, host_name):
-    """Sets the DNS cname of the instance to host_name."""
+    """Sets the DNS cname of the instance to host_name. The change
+    propagates in the background; see `dns_changes`."""
+
+    zone = adns.ZoneSync(dns_changes().r53)
+    adns.sync_instance(zone, instance)
+    dns_changes().track(zone.commit())
+    dns_changes().start()
+
+# sshd port by instance id, for instances whose image already has
+# configure_ssh done. Others start on 22.
+ssh_ports = {}
+
+_sessions = {}
+def session(instance):
+    """Returns the ssh session shared by every command run on `instance`."""
 
-    r53 = adns.connect()
-    rrs = adns.current_rrs(r53)
-    rrs.sync_instance(rrs, instance)
-    rrs.commit()
+    if instance.id not in _sessions:
+        _sessions[instance.id] = remote.Session(instance.public_dns_name, key_path=aws_pem,
+                                                port=ssh_ports.get(instance.id, 22))
+
+    return _sessions[instance.id]
 
 def configure_instance(instance, host_name, instance_type="default"):
     """Add the EC2 metadata tags and run the remote configuration on the new instance."""
 
-    user_host = "ubuntu@%s" % instance.public_dns_name
-
     instance.add_tag("instance_type", instance_type)
     instance.add_tag("Name", host_name)
-    remove_stale_host_keys(instance)
-    wait_for_ssh(instance)
 
-    log.info("Copying configuration scripts to %s", user_host)
-    subp.check_call(["rsync", "-a", "--exclude", ".git/", "-e", "ssh -i" + aws_pem, ".", "%s:setup_ec2" % user_host])
+    provision(instance, host_name, instance_type)
+    set_dns_cname(instance, host_name)
 
-    log.info("Configuring %s as %s", user_host, instance_type)
-    subp.check_call(["ssh", "-i", aws_pem, user_host, "-t", 
-                     "cd setup_ec2/aws && python setup_ec2.py %s %s" % (instance_type, host_name)])
+def provision(instance, host_name, instance_type, *options):
+    """Ships the bundle and artifacts to the instance and runs setup_ec2
+    on it, with `options` passed on to setup_ec2."""
 
-    set_dns_cname(instance, host_name)
+    log.info("Copying configuration scripts to %s", instance.public_dns_name)
+    with timeline.span("ship bundle", host=host_name):
+        bundle.ship(session(instance), bundle.build())
+
+    with timeline.span("push artifacts", host=host_name):
+        push_artifacts(session(instance), instance_type)
+
+    # Image builders don't get the site.
+    if instance_type in site_server_types and "--bake" not in options:
+        with timeline.span("push git bundles", host=host_name):
+            gitcache.ship(session(instance))
+
+    log.info("Configuring %s as %s", instance.public_dns_name, instance_type)
+    with timeline.span("setup_ec2.py %s" % instance_type, host=host_name):
+        session(instance).run(remote.remote_script("setup_ec2.py", instance_type, host_name, *options), tty=True)
+    fetch_trace(session(instance), "setup_ec2.py", host_name)
+
+    with timeline.span("pull artifacts", host=host_name):
+        pull_artifacts(session(instance))
+
+# Server types that get the site (setup_web), and so need the
+# wheelhouse and virtualenv artifacts.
+site_server_types = set(["web", "celery", "jenkins", "staging"])
+
+def push_artifacts(session, server_type):
+    """Copies the artifacts a `server_type` host needs from the local
+    cache to the host, so setup_ec2 can install prebuilt artifacts
+    rather than building them."""
+
+    if not opath.isdir(artifacts.local_dir):
+        os.makedirs(artifacts.local_dir)
+
+    excludes = ["tmp*"]
+    if server_type not in site_server_types:
+        excludes += ["wheelhouse-*", "venv-*"]
+
+    session.run("mkdir -p %s" % artifacts.remote_dir)
+    session.rsync(artifacts.local_dir + "/", artifacts.remote_dir + "/", excludes=excludes)
+
+# memrise's copy of the artifact cache, which setup_web builds the
+# site's virtualenv from.
+memrise_artifacts_dir = "/home/memrise/" + artifacts.remote_dir
+
+def pull_artifacts(session, remote_dir=artifacts.remote_dir):
+    """Copies back any artifacts the host built, for the next host.
+    setup_ec2 has moved sshd to port 2000 by then."""
+
+    session.fetch(remote_dir + "/", artifacts.local_dir + "/", excludes=["tmp*"], port=2000)
+
+# Volume sets created for database instances, by instance id.
+database_storage = {}
 
 def create_database_storage(ec2):
-    """Creates four EBS devices and returns a list of their names."""
+    """Requests four 50GB EBS volumes and returns their `ebs.VolumeSet`."""
 
-    vols = []
-    for i in xrange(4):
-        vol = ec2.create_volume(50, "us-east-1d")
-        vols.append(vol.id)
+    return ebs.VolumeSet(ec2, 4, 50, "us-east-1d")
 
-    return vols
+def fetch_trace(session, script, host_name):
+    """Copies the trace `script` wrote on the host, when this run is
+    traced, and adds its spans to this run's under `host_name`. The
+    script has moved sshd to port 2000 by then."""
 
-def attach_volumes(ec2, instance, volumes):
-    """Attach a set of EBS volumes to an instance. volumes should be a
-    sequence of boto.ec2.volume.id strings as returned by
-    create_database_storage. They're attached in the same order
-    they're passed, starting from /dev/sdh."""
+    if not timeline.trace_path:
+        return
 
-    for i, vol in enumerate(volumes):
-        device = "/dev/sd%s" % chr((ord("h") + i))
-        ec2.attach_volume(vol, instance.id, device)
+    fd, path = tempf.mkstemp(prefix="trace-")
+    os.close(fd)
+    try:
+        session.fetch(remote.script_dir + "/" + remote.trace_name(script), path, port=2000)
+        timeline.load(path, host_name)
+    except (subp.CalledProcessError, IOError, ValueError), e:
+        log.warning("Couldn't fetch the %s trace from %s: %s", script, host_name, e)
+    finally:
+        os.remove(path)
 
-def start_web_instance(ec2, host_name):
-    instance = start_instance(ec2, instance_type=instance_types["web"])
+def setup_web(instance, command):
+    """Runs setup_web.py `command` on the instance, once sshd is on port 2000."""
+
+    with timeline.span("setup_web.py %s" % command, host=instance.tags.get(u"Name")):
+        session(instance).run(remote.remote_script("setup_web.py", command), port=2000)
+    fetch_trace(session(instance), "setup_web.py", instance.tags.get(u"Name"))
+
+    if session(instance).call("test -d %s" % memrise_artifacts_dir, port=2000) == 0:
+        pull_artifacts(session(instance), memrise_artifacts_dir)
+
+def configure_web_instance(ec2, instance, host_name):
     configure_instance(instance, host_name, "web")
 
     log.info("Starting web instance configuration")
-    subp.check_call(["ssh", "-i", aws_pem, "-p", "2000", "ubuntu@" + instance.public_dns_name,
-                     "cd setup_ec2/aws && python setup_web.py web"])
+    setup_web(instance, "web")
 
-def start_celery_instance(ec2, host_name):
-    instance = start_instance(ec2, instance_type="m1.small")
+def configure_celery_instance(ec2, instance, host_name):
     configure_instance(instance, host_name, "celery")
 
     log.info("Starting celery instance configuration")
-    subp.check_call(["ssh", "-i", aws_pem, "-p", "2000", "ubuntu@" + instance.public_dns_name,
-                     "cd setup_ec2/aws && python setup_web.py celery"])
+    setup_web(instance, "celery")
 
-
-def start_jenkins_instance(ec2, host_name):
-    instance = start_instance(ec2, instance_type=instance_types["jenkins"])
+def configure_jenkins_instance(ec2, instance, host_name):
     configure_instance(instance, host_name, "jenkins")
 
     log.info("Starting jenkins instance configuration")
-    subp.check_call(["ssh", "-i", aws_pem, "-p", "2000", "ubuntu@" + instance.public_dns_name,
-                     "cd setup_ec2/aws && python setup_web.py jenkins"])
+    setup_web(instance, "jenkins")
 
-def start_rabbitmq_instance(ec2, host_name):
-    instance = start_instance(ec2, instance_type=instance_types["rabbitmq"])
+def configure_rabbitmq_instance(ec2, instance, host_name):
     configure_instance(instance, host_name, "rabbitmq")
 
-def start_database_instance(ec2, host_name):
-    instance = start_instance(ec2, instance_types["database"])
-    volumes = create_database_storage(ec2)
-    attach_volumes(ec2, instance, volumes)
+def configure_database_instance(ec2, instance, host_name):
+    database_storage[instance.id].wait_attached()
     configure_instance(instance, host_name, "mysql")
 
-def start_staging_instance(ec2, host_name):
-    instance = start_instance(ec2, instance_types["staging"])
+def configure_staging_instance(ec2, instance, host_name):
     configure_instance(instance, host_name, "staging")
-    subp.check_call(["ssh", "-i", aws_pem, "-p", "2000", "ubuntu@" + instance.public_dns_name,
-                     "cd setup_ec2/aws && python setup_web.py web"])
+    setup_web(instance, "web")
 
-def start_backupdb_instance(ec2, host_name):
-    instance = start_instance(ec2, instance_type=instance_types["database"])
+def configure_backupdb_instance(ec2, instance, host_name):
     configure_instance(instance, host_name, "backupdb")
 
+# Maps each server type to the EC2 instance type it runs on and the
+# function that configures a running instance of it.
+server_types = {"web": (instance_types["web"], configure_web_instance),
+                "celery": ("m1.small", configure_celery_instance),
+                "staging": (instance_types["staging"], configure_staging_instance),
+                "jenkins": (instance_types["jenkins"], configure_jenkins_instance),
+                "rabbitmq": (instance_types["rabbitmq"], configure_rabbitmq_instance),
+                "backupdb": (instance_types["database"], configure_backupdb_instance),
+                "mysql": (instance_types["database"], configure_database_instance)}
+
+# Server types whose instances get database storage at launch.
+storage_server_types = set(["mysql"])
+
+# Number of hosts configured at the same time.
+default_workers = 8
+
+def baked_image(server_type):
+    """Returns the registry entry for the image baked for `server_type`
+    from the current bundle, or None; see bake_ami."""
+
+    instance_type = server_types[server_type][0]
+    return amis.Registry().newest(server_type, bundle.build().hash, instance_ami_map[instance_type])
+
+def launch(ec2, server_type, host_names, workers=default_workers):
+    """Starts one `server_type` instance per host name in a single
+    request, then configures them all concurrently with at most
+    `workers` at a time. Returns a (host_name, instance, error) tuple
+    per host; error is `None` if the host was configured."""
+
+    instance_type, configure = server_types[server_type]
+
+    baked = baked_image(server_type)
+    if baked is not None:
+        log.info("Launching from baked image %s", baked["ami"])
+    else:
+        log.info("No %s image baked from bundle %s; launching the stock image", server_type, bundle.build().hash)
+
+    instances = start_instances(ec2, instance_type, len(host_names),
+                                storage=server_type in storage_server_types,
+                                ami=baked["ami"] if baked is not None else None)
+    port = 2000 if baked is not None else 22
+    for instance in instances:
+        ssh_ports[instance.id] = port
+
+    remove_stale_host_keys(instances)
+    dns_changes()
+
+    # From the stock image, the first host to come up is configured on
+    # its own, so that what it builds (MySQL, the wheelhouse) is in the
+    # artifact cache when the others are provisioned, rather than every
+    # host building it at once. Baked images have it already.
+    seeding = baked is None and len(instances) > 1
+    seed_lock = threading.Lock()
+    seed_done = threading.Event()
+    seeds = []
+
+    def configure_host(host_name, instance):
+        with seed_lock:
+            is_seed = seeding and not seeds
+            seeds.append(instance.id)
+
+        if seeding and not is_seed:
+            seed_done.wait()
+
+        try:
+            with timeline.span("configure %s" % server_type, host=host_name):
+                configure(ec2, instance, host_name)
+        except Exception, e:
+            log.exception("Configuring %s (%s) failed", host_name, instance.id)
+            return host_name, instance, e
+        finally:
+            if is_seed:
+                log.info("Done with %s; configuring the other hosts", host_name)
+                seed_done.set()
+
+        log.info("Configured %s (%s)", host_name, instance.id)
+        return host_name, instance, None
+
+    names = dict(zip((i.id for i in instances), host_names))
+    results = {}
+    pool = ThreadPool(min(workers, len(instances)))
+
+    def ssh_ready(instance):
+        results[instance.id] = pool.apply_async(configure_host, (names[instance.id], instance)).get
+
+    def ssh_timeout(instance):
+        log.error("ssh never came up on %s (%s)", names[instance.id], instance.id)
+        error = Exception("ssh never came up on %s" % instance.public_dns_name)
+        results[instance.id] = lambda: (names[instance.id], instance, error)
+
+    try:
+        waiter = wt.Waiter()
+        wait_for_ssh(instances, waiter, ssh_ready, ssh_timeout, port=port)
+        waiter.run()
+
+        return [results[i.id]() for i in instances]
+    finally:
+        pool.close()
+        pool.join()
+        [session(i).close() for i in instances]
+
+def start_web_instance(ec2, host_name):
+    return launch(ec2, "web", [host_name])
+
+def start_celery_instance(ec2, host_name):
+    return launch(ec2, "celery", [host_name])
+
+def start_jenkins_instance(ec2, host_name):
+    return launch(ec2, "jenkins", [host_name])
+
+def start_rabbitmq_instance(ec2, host_name):
+    return launch(ec2, "rabbitmq", [host_name])
+
+def start_database_instance(ec2, host_name):
+    return launch(ec2, "mysql", [host_name])
+
+def start_staging_instance(ec2, host_name):
+    return launch(ec2, "staging", [host_name])
+
+def start_backupdb_instance(ec2, host_name):
+    return launch(ec2, "backupdb", [host_name])
+
 server_type_map = {"web": start_web_instance,
                    "celery": start_celery_instance,
                    "staging": start_staging_instance,
@@ -194,12 +437,48 @@ server_type_map = {"web": start_web_instance,
                    "backupdb": start_backupdb_instance,
                    "mysql": start_database_instance}
 
+host_range_re = re.compile(r"^(.*?)\[([0-9]+)-([0-9]+)\]$")
+host_number_re = re.compile(r"^(.*?)([0-9]+)$")
+def host_names(spec, count=1):
+    """Expands a host name spec into host names: `web[3-5]` gives web3,
+    web4 and web5, as does `web3` with a `count` of 3."""
+
+    m = host_range_re.match(spec)
+    if m:
+        prefix, first, last = m.group(1), int(m.group(2)), int(m.group(3))
+        return ["%s%d" % (prefix, n) for n in xrange(first, last + 1)]
+
+    if count == 1:
+        return [spec]
+
+    m = host_number_re.match(spec)
+    if not m:
+        raise ValueError("Host name %s needs a number to start counting from." % spec)
+
+    prefix, first = m.group(1), int(m.group(2))
+    return ["%s%d" % (prefix, n) for n in xrange(first, first + count)]
+
 def main():
     """
-    e.g. ../venv/bin/python start_instancepy web web3
+    e.g. ../venv/bin/python start_instance.py web web3
+         ../venv/bin/python start_instance.py web 'web[3-7]'
+         ../venv/bin/python start_instance.py --count 5 web web3
     """
-    server_type = server_type_map[sys.argv[1]]
-    host_name = sys.argv[2]
+    parser = argparse.ArgumentParser(description="Start and configure instances.")
+    parser.add_argument("server_type", choices=sorted(server_types))
+    parser.add_argument("host_name", help="host name, or a range such as web[3-7]")
+    parser.add_argument("--count", type=int, default=1, help="number of hosts, numbered up from host_name")
+    parser.add_argument("--workers", type=int, default=default_workers, help="hosts to configure at once")
+    args = parser.parse_args()
 
     ec2 = boto.connect_ec2()
-    server_type(ec2, host_name)
+    results = launch(ec2, args.server_type, host_names(args.host_name, args.count), args.workers)
+
+    dns_changes().wait()
+
+    failed = [r for r in results if r[2] is not None]
+    for host_name, instance, error in results:
+        print "%s\t%s\t%s" % (host_name, instance.id, "FAILED: %s" % error if error is not None else "ok")
+
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,171 @@
+"""Runs setup steps concurrently, in dependency order.
+
+Each step names the steps it depends on and the locks it needs ("apt"
+for the dpkg lock, "etc" for writes under /etc). A step starts as soon
+as its dependencies have finished and none of its locks are held, so
+bring-up takes as long as the longest chain of steps rather than the
+sum of all of them."""
+
+import logging
+import sys
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+log = logging.getLogger("steps")
+
+class Step(object):
+    def __init__(self, name, func, args, deps, locks):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.deps = deps
+        self.locks = locks
+        self.started = None
+        self.finished = None
+
+    @property
+    def duration(self):
+        if self.started is None or self.finished is None:
+            return 0
+
+        return self.finished - self.started
+
+class Plan(object):
+    """A set of steps and the order constraints between them."""
+
+    def __init__(self):
+        self.steps = []
+        self._by_name = {}
+
+    def add(self, name, func, *args, **kwargs):
+        """Adds step `name`, which runs `func(*args)`. Keyword arguments
+        `deps` and `locks` list the steps it must follow and the locks it
+        holds. Dependencies must already be in the plan."""
+
+        deps = kwargs.pop("deps", ())
+        locks = kwargs.pop("locks", ())
+        if kwargs:
+            raise TypeError("Unexpected arguments: %s" % ", ".join(kwargs))
+
+        missing = [d for d in deps if d not in self._by_name]
+        if missing:
+            raise ValueError("Step %s depends on unknown steps: %s" % (name, ", ".join(missing)))
+        if name in self._by_name:
+            raise ValueError("Step %s is already in the plan" % name)
+
+        step = Step(name, func, args, tuple(deps), tuple(locks))
+        self.steps.append(step)
+        self._by_name[name] = step
+
+        return step
+
+    def without(self, names):
+        """Returns a copy of the plan without the steps `names` or any
+        step that depends on them."""
+
+        dropped = set(names)
+        plan = Plan()
+        for step in self.steps:
+            if step.name in dropped or dropped.intersection(step.deps):
+                dropped.add(step.name)
+                continue
+            plan.add(step.name, step.func, *step.args, deps=step.deps, locks=step.locks)
+
+        return plan
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def run(self, journal, workers=4):
+        """Runs every step through `journal`, at most `workers` at a time.
+
+        When a step fails, no more steps are started; the ones running
+        are allowed to finish, then the first failure is re-raised."""
+
+        cond = threading.Condition()
+        pending = list(self.steps)
+        running = set()
+        done = set()
+        held = set()
+        failures = []
+
+        def run_step(step):
+            exc_info = None
+            step.started = time.time()
+            try:
+                journal.run(step.name, step.func, *step.args)
+            except:
+                exc_info = sys.exc_info()
+            step.finished = time.time()
+
+            with cond:
+                running.discard(step.name)
+                held.difference_update(step.locks)
+                if exc_info is None:
+                    done.add(step.name)
+                else:
+                    log.error("Step %s failed: %s", step.name, exc_info[1])
+                    failures.append(exc_info)
+                cond.notify()
+
+        pool = ThreadPool(workers)
+        try:
+            with cond:
+                while True:
+                    if not failures:
+                        for step in list(pending):
+                            if len(running) >= workers:
+                                break
+                            if not all(d in done for d in step.deps) or held.intersection(step.locks):
+                                continue
+
+                            pending.remove(step)
+                            running.add(step.name)
+                            held.update(step.locks)
+                            pool.apply_async(run_step, (step,))
+
+                    if not running:
+                        break
+
+                    # Waiting with a timeout keeps the main thread interruptible.
+                    cond.wait(1)
+        finally:
+            pool.close()
+            pool.join()
+
+        if failures:
+            exc_info = failures[0]
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def critical_path(self):
+        """Returns the chain of dependent steps with the longest total
+        duration in the last run, first step first."""
+
+        finish = {}
+        prev = {}
+        for step in self.steps:
+            before = max(step.deps, key=lambda d: finish[d]) if step.deps else None
+            finish[step.name] = step.duration + (finish[before] if before else 0)
+            prev[step.name] = before
+
+        if not finish:
+            return []
+
+        name = max(finish, key=finish.get)
+        path = []
+        while name is not None:
+            path.append(self._by_name[name])
+            name = prev[name]
+
+        return path[::-1]
+
+    def report(self):
+        """Logs the critical path of the last run."""
+
+        path = self.critical_path()
+        total = sum(s.duration for s in self.steps)
+        log.info("Critical path %.1fs of %.1fs total step time:", sum(s.duration for s in path), total)
+        for step in path:
+            log.info("%8.1fs  %s", step.duration, step.name)
@@ -0,0 +1,280 @@
+"""Plans the RAID, LVM and filesystem layout for database storage.
+
+The planner is pure: it turns a device list into the commands that
+build the array, volume and filesystem, with the md chunk size, the
+LVM data alignment and the ext4 stride and stripe width all derived
+from one another, so writes line up with the stripes. The plan can be
+printed, run through runcmd's dry-run backend, or applied to loop
+devices to try it out:
+
+    python storage.py /dev/sdh /dev/sdi /dev/sdj /dev/sdk
+    sudo python storage.py --loop 4 --size 256 --apply --teardown"""
+
+import argparse
+import logging
+import os.path as opath
+import shutil
+import subprocess as subp
+
+log = logging.getLogger("storage")
+
+# ext4 block size.
+block_kb = 4
+
+# Data disks per device for each RAID level. RAID10 keeps two copies.
+data_disk_ratio = {"raid10": 0.5, "raid0": 1, "raid1": None, "single": None}
+
+# Full stripe the chunk size is chosen for: one InnoDB extent (1MB),
+# or two on arrays of at least `large_array_gb`, whose big tables are
+# mostly read sequentially by scans and backups.
+target_stripe_kb = 1024
+large_array_gb = 500
+
+def choose_chunk_kb(data_disks, sizes_gb=None):
+    """Returns the md chunk size, a power of two from 64K to 512K, that
+    gives the target full stripe across `data_disks` devices of
+    `sizes_gb`."""
+
+    stripe_kb = target_stripe_kb
+    if sizes_gb is not None and min(sizes_gb) * data_disks >= large_array_gb:
+        stripe_kb *= 2
+
+    chunk_kb = 64
+    while chunk_kb < 512 and chunk_kb * 2 * data_disks <= stripe_kb:
+        chunk_kb *= 2
+
+    return chunk_kb
+
+def device_sizes_gb(devices):
+    """Returns the sizes of `devices` in GB from sysfs, or None if any of
+    them isn't there yet."""
+
+    sizes = []
+    for dev in devices:
+        path = "/sys/class/block/%s/size" % opath.basename(opath.realpath(dev))
+        if not opath.exists(path):
+            return None
+        with open(path) as size_in:
+            sizes.append(int(size_in.read()) * 512 / float(1 << 30))
+
+    return sizes
+
+def choose_level(count):
+    """RAID10 with four or more devices, RAID0 with two or three, and no
+    RAID with one."""
+
+    if count >= 4 and count % 2 == 0:
+        return "raid10"
+    if count >= 2:
+        return "raid0"
+
+    return "single"
+
+class StoragePlan(object):
+    """The layout of `devices` as one filesystem mounted at `mount_point`.
+
+    `chunk_kb` is the md chunk size of a striped layout, chosen from
+    the number of data disks and the device sizes `sizes_gb` (see
+    `choose_chunk_kb`) if not given, and None otherwise; `lv_percent` is the share of the volume group the logical
+    volume gets, leaving the rest for snapshots. Readahead is set to two
+    full stripes."""
+
+    def __init__(self, devices, level=None, chunk_kb=None, sizes_gb=None, md_device="/dev/md0",
+                 volume_group="mysql", volume="mysql", mount_point="/mysql", lv_percent=75,
+                 mount_options=("nodev", "nosuid", "noatime")):
+        self.devices = list(devices)
+        self.level = level or choose_level(len(self.devices))
+        self.sizes_gb = sizes_gb
+        self.md_device = md_device
+        self.volume_group = volume_group
+        self.volume = volume
+        self.mount_point = mount_point
+        self.lv_percent = lv_percent
+        self.mount_options = list(mount_options)
+
+        if self.level not in data_disk_ratio:
+            raise ValueError("Unknown RAID level %s" % self.level)
+        if not self.devices:
+            raise ValueError("No devices to lay out")
+        if self.level == "single" and len(self.devices) != 1:
+            raise ValueError("A single-device layout takes one device, not %d" % len(self.devices))
+        if self.level == "raid10" and len(self.devices) % 2:
+            raise ValueError("RAID10 needs an even number of devices, not %d" % len(self.devices))
+        if sizes_gb is not None and len(sizes_gb) != len(self.devices):
+            raise ValueError("Got %d sizes for %d devices" % (len(sizes_gb), len(self.devices)))
+        if sizes_gb is not None and len(set(sizes_gb)) > 1:
+            log.warning("Devices differ in size; each only contributes %dGB", min(sizes_gb))
+
+        self.chunk_kb = (chunk_kb or choose_chunk_kb(self.data_disks, sizes_gb)) if self.striped else None
+
+    @property
+    def striped(self):
+        return self.level in ("raid10", "raid0")
+
+    @property
+    def data_disks(self):
+        ratio = data_disk_ratio[self.level]
+        return int(len(self.devices) * ratio) if ratio else 1
+
+    @property
+    def array_device(self):
+        return self.devices[0] if self.level == "single" else self.md_device
+
+    @property
+    def lv_device(self):
+        return "/dev/%s/%s" % (self.volume_group, self.volume)
+
+    @property
+    def stripe_kb(self):
+        return self.chunk_kb * self.data_disks if self.striped else block_kb
+
+    @property
+    def stride(self):
+        """Filesystem blocks per chunk, or None if not striped."""
+
+        return self.chunk_kb / block_kb if self.striped else None
+
+    @property
+    def stripe_width(self):
+        """Filesystem blocks per full stripe, or None if not striped."""
+
+        return self.stride * self.data_disks if self.striped else None
+
+    @property
+    def readahead_sectors(self):
+        return max(256, self.stripe_kb * 2 * 2)
+
+    @property
+    def usable_gb(self):
+        if self.sizes_gb is None:
+            return None
+
+        return min(self.sizes_gb) * self.data_disks
+
+    def commands(self):
+        """Returns the commands that build the layout, to be run as root."""
+
+        cmds = []
+        if self.level != "single":
+            mdadm = ["mdadm", "--create", self.md_device, "--run", "--level=%s" % self.level[len("raid"):],
+                     "--raid-devices=%d" % len(self.devices)]
+            if self.striped:
+                mdadm.append("--chunk=%d" % self.chunk_kb)
+            if self.level == "raid10":
+                mdadm.append("--layout=n2")
+            cmds.append(mdadm + self.devices)
+
+        cmds += [["pvcreate", "--dataalignment", "%dk" % self.stripe_kb, self.array_device],
+                 ["vgcreate", self.volume_group, self.array_device],
+                 ["lvcreate", "-n", self.volume, "-l", "%d%%FREE" % self.lv_percent, self.volume_group]]
+
+        mkfs = ["mkfs.ext4", "-b", str(block_kb * 1024)]
+        if self.striped:
+            mkfs += ["-E", "stride=%d,stripe-width=%d" % (self.stride, self.stripe_width)]
+        cmds.append(mkfs + [self.lv_device])
+
+        cmds += [["blockdev", "--setra", str(self.readahead_sectors), dev] for dev in self.readahead_devices()]
+
+        return cmds
+
+    def readahead_devices(self):
+        return [self.array_device, self.lv_device]
+
+    def teardown_commands(self):
+        """Returns the commands that undo `commands`."""
+
+        cmds = [["lvremove", "-f", self.lv_device],
+                ["vgremove", "-f", self.volume_group],
+                ["pvremove", "-f", self.array_device]]
+        if self.level != "single":
+            cmds.append(["mdadm", "--stop", self.md_device])
+            cmds.append(["mdadm", "--zero-superblock"] + self.devices)
+
+        return cmds
+
+    def fstab_line(self):
+        return "\t".join((self.lv_device, self.mount_point, "ext4", ",".join(self.mount_options), "0", "0"))
+
+    def udev_rules(self):
+        """Returns udev rules that reapply the readahead at boot, since
+        blockdev --setra doesn't persist."""
+
+        read_ahead_kb = self.readahead_sectors / 2
+        return ['SUBSYSTEM=="block", KERNEL=="%s", ACTION=="add|change", ATTR{bdi/read_ahead_kb}="%d"'
+                % (opath.basename(self.md_device), read_ahead_kb),
+                'SUBSYSTEM=="block", ENV{DM_VG_NAME}=="%s", ENV{DM_LV_NAME}=="%s", ACTION=="add|change", '
+                'ATTR{bdi/read_ahead_kb}="%d"' % (self.volume_group, self.volume, read_ahead_kb)]
+
+    def describe(self):
+        if not self.striped:
+            return "%s over %d devices: readahead %d sectors" % (self.level, len(self.devices), self.readahead_sectors)
+
+        return ("%s over %d devices, %dK chunks, %d data disks: stride %d, stripe width %d, readahead %d sectors"
+                % (self.level, len(self.devices), self.chunk_kb, self.data_disks,
+                   self.stride, self.stripe_width, self.readahead_sectors))
+
+def loop_devices(count, size_mb, dir_name):
+    """Attaches `count` sparse files of `size_mb` in `dir_name` to loop
+    devices and returns the devices. Needs root."""
+
+    devices = []
+    for i in xrange(count):
+        path = opath.join(dir_name, "disk%d.img" % i)
+        with open(path, "wb") as img_out:
+            img_out.truncate(size_mb * 1024 * 1024)
+        devices.append(subp.check_output(["losetup", "--find", "--show", path]).strip())
+
+    return devices
+
+if __name__ == "__main__":
+    import runcmd
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Plan (and optionally build) a RAID/LVM/ext4 layout.")
+    parser.add_argument("devices", nargs="*")
+    parser.add_argument("--level", choices=sorted(data_disk_ratio))
+    parser.add_argument("--chunk", type=int, help="md chunk size in KB (default: from the devices)")
+    parser.add_argument("--md-device", default="/dev/md0")
+    parser.add_argument("--volume-group", default="mysql")
+    parser.add_argument("--loop", type=int, metavar="N", help="lay out N new loop devices instead")
+    parser.add_argument("--size", type=int, default=256, help="loop device size in MB (default: %(default)s)")
+    parser.add_argument("--apply", action="store_true", help="run the plan (as root)")
+    parser.add_argument("--teardown", action="store_true", help="undo the layout after applying it")
+    args = parser.parse_args()
+
+    if args.loop and not args.apply:
+        parser.error("--loop needs --apply")
+
+    loop_dir = None
+    devices = args.devices
+    if args.loop:
+        loop_dir = runcmd.temp_dir(prefix="storage-")
+        devices = loop_devices(args.loop, args.size, loop_dir)
+
+    plan = StoragePlan(devices, level=args.level, chunk_kb=args.chunk, sizes_gb=device_sizes_gb(devices),
+                       md_device=args.md_device, volume_group=args.volume_group)
+    print "#", plan.describe()
+    for cmd in plan.commands():
+        print " ".join(cmd)
+    print "# fstab:", plan.fstab_line()
+
+    if args.apply:
+        try:
+            for cmd in plan.commands():
+                runcmd.run(cmd)
+            runcmd.run(["tune2fs", "-l", plan.lv_device])
+        finally:
+            # Teardown errors are only logged, so they don't hide the
+            # error that stopped the plan, if any.
+            if args.teardown:
+                cmds = plan.teardown_commands()
+                if loop_dir is not None:
+                    cmds += [["losetup", "-d", dev] for dev in devices]
+                for cmd in cmds:
+                    try:
+                        runcmd.run(cmd)
+                    except (subp.CalledProcessError, OSError), e:
+                        log.error("Teardown command %s failed: %s", " ".join(cmd), e)
+                if loop_dir is not None:
+                    shutil.rmtree(loop_dir, ignore_errors=True)
@@ -0,0 +1,38 @@
+"""Checks that sudo batch scripts quote and expand words as the shell would.
+
+    cd aint && python -m unittest test_runcmd"""
+
+import os.path as opath
+import pwd
+import subprocess as subp
+import unittest
+
+import runcmd
+
+def sh_echo(word):
+    """Returns what `sh -c` makes of `word` as a single argument."""
+
+    return subp.check_output(["sh", "-c", 'printf "%s" ' + word])
+
+class ShellWordTest(unittest.TestCase):
+    def setUp(self):
+        self.user = pwd.getpwuid(0).pw_name
+        self.home = opath.expanduser("~" + self.user)
+
+    def test_plain_words_are_quoted(self):
+        for word in ["a b", "it's", "$HOME", "*", ""]:
+            self.assertEqual(sh_echo(runcmd.shell_word(word)), word)
+
+    def test_home_expands(self):
+        self.assertEqual(sh_echo(runcmd.shell_word("~" + self.user)), self.home)
+        self.assertEqual(sh_echo(runcmd.shell_word("~%s/" % self.user)), self.home + "/")
+        self.assertEqual(sh_echo(runcmd.shell_word("~%s/.ssh" % self.user)), self.home + "/.ssh")
+
+    def test_home_expands_before_quoted_rest(self):
+        self.assertEqual(sh_echo(runcmd.shell_word("~%s/x y/$z" % self.user)), self.home + "/x y/$z")
+
+    def test_tilde_inside_is_literal(self):
+        self.assertEqual(sh_echo(runcmd.shell_word("a/~%s" % self.user)), "a/~" + self.user)
+
+if __name__ == "__main__":
+    unittest.main()
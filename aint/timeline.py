@@ -0,0 +1,182 @@
+"""Records how long provisioning steps take.
+
+Spans are recorded around commands, waits and setup steps, and can be
+exported as a Chrome trace (load it in chrome://tracing or Perfetto)
+or summarised as the slowest steps. Set AINT_TRACE to a path to write
+the trace and log the summary when the process exits."""
+
+import atexit
+import contextlib
+import functools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+log = logging.getLogger("timeline")
+
+HOSTNAME = socket.gethostname()
+
+# Where to write the trace at exit, if anywhere.
+trace_path = os.environ.get("AINT_TRACE")
+
+class Span(object):
+    def __init__(self, name, category, host, start, end, status, args):
+        self.name = name
+        self.category = category
+        self.host = host
+        self.start = start
+        self.end = end
+        self.status = status
+        self.args = args
+        self.thread = threading.current_thread().name
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+_spans = []
+_lock = threading.Lock()
+
+@contextlib.contextmanager
+def span(name, category="step", host=None, **args):
+    """Records the time taken by the block as a span. The block gets
+    the span's `args` dict, and can add to it (e.g. an exit status)."""
+
+    start = time.time()
+    status = "ok"
+    try:
+        yield args
+    except:
+        status = "error"
+        raise
+    finally:
+        with _lock:
+            _spans.append(Span(name, category, host or HOSTNAME, start, time.time(), status, args))
+
+def traced(func):
+    """Records each call of `func` as a span named after it."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+def spans():
+    with _lock:
+        return list(_spans)
+
+def trace_events():
+    """Returns the spans as Chrome trace events, one process per host
+    and one numbered thread per thread that recorded spans on it, named
+    in metadata events."""
+
+    pids = {}
+    tids = {}
+    events = []
+    for s in spans():
+        if s.host not in pids:
+            pids[s.host] = len(pids) + 1
+            events.append({"name": "process_name", "ph": "M", "pid": pids[s.host], "tid": 0,
+                           "args": {"name": s.host}})
+
+        if (s.host, s.thread) not in tids:
+            tids[s.host, s.thread] = len(tids) + 1
+            events.append({"name": "thread_name", "ph": "M", "pid": pids[s.host], "tid": tids[s.host, s.thread],
+                           "args": {"name": s.thread}})
+
+        args = dict(s.args, status=s.status)
+        events.append({"name": s.name, "cat": s.category, "ph": "X",
+                       "ts": int(s.start * 1e6), "dur": int(s.duration * 1e6),
+                       "pid": pids[s.host], "tid": tids[s.host, s.thread],
+                       "args": dict((k, str(v)) for k, v in args.items())})
+
+    return events
+
+def export(path):
+    """Writes the spans recorded so far to `path` as a Chrome trace."""
+
+    with open(path, "w") as trace_out:
+        json.dump({"traceEvents": trace_events(), "displayTimeUnit": "ms"}, trace_out)
+
+def load(path, host=None):
+    """Adds the spans in the trace at `path`, written by `export` in
+    another process (such as setup_ec2 on a host), to this process's
+    spans. They are put under `host` if given, on threads named after
+    the host that recorded them, so they don't mix with this process's
+    threads."""
+
+    with open(path) as trace_in:
+        events = json.load(trace_in)["traceEvents"]
+
+    hosts = {}
+    threads = {}
+    for e in events:
+        if e["ph"] == "M" and e["name"] == "process_name":
+            hosts[e["pid"]] = e["args"]["name"]
+        elif e["ph"] == "M" and e["name"] == "thread_name":
+            threads[e["pid"], e["tid"]] = e["args"]["name"]
+
+    loaded = []
+    for e in events:
+        if e["ph"] != "X":
+            continue
+
+        args = dict(e["args"])
+        status = args.pop("status", "ok")
+        recorded_host = hosts.get(e["pid"], HOSTNAME)
+        s = Span(e["name"], e["cat"], host or recorded_host,
+                 e["ts"] / 1e6, (e["ts"] + e["dur"]) / 1e6, status, args)
+        s.thread = "%s %s" % (recorded_host, threads.get((e["pid"], e["tid"]), e["tid"]))
+        loaded.append(s)
+
+    with _lock:
+        _spans.extend(loaded)
+
+def self_times(spans):
+    """Returns each of `spans`' duration less that of the spans directly
+    nested in it (on the same host and thread), keyed by span."""
+
+    self_time = dict((s, s.duration) for s in spans)
+
+    by_thread = {}
+    for s in spans:
+        by_thread.setdefault((s.host, s.thread), []).append(s)
+
+    for thread_spans in by_thread.values():
+        open_spans = []
+        for s in sorted(thread_spans, key=lambda s: (s.start, -s.end)):
+            while open_spans and open_spans[-1].end <= s.start:
+                open_spans.pop()
+            if open_spans:
+                self_time[open_spans[-1]] -= s.duration
+            open_spans.append(s)
+
+    return self_time
+
+def summary(n=10):
+    """Returns lines describing the `n` spans with the most time of
+    their own, so that a step isn't ranked by the commands inside it."""
+
+    self_time = self_times(spans())
+    slowest = sorted(self_time, key=self_time.get, reverse=True)[:n]
+
+    return ["%8.1fs %8.1fs  %-8s %-20s %s%s" % (self_time[s], s.duration, s.category, s.host, s.name,
+                                                "" if s.status == "ok" else " (%s)" % s.status)
+            for s in slowest]
+
+def _export_at_exit():
+    if not spans():
+        return
+
+    export(trace_path)
+    log.info("Wrote trace to %s. Slowest steps (own time, total time):", trace_path)
+    for line in summary():
+        log.info(line)
+
+if trace_path:
+    atexit.register(_export_at_exit)
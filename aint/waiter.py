@@ -0,0 +1,212 @@
+"""Waits on many conditions at once from a single polling loop.
+
+Each condition is polled on the same exponential-backoff schedule, so
+waiting on twenty hosts costs one schedule rather than twenty, and each
+condition's callback runs as soon as that condition is met. An error
+in one condition or hook doesn't stop the others: it is logged and
+tried again on the next poll, unless the condition gives up by raising
+`ConditionFailed`."""
+
+import logging
+import random
+import sys
+import threading
+import time
+import timeline
+
+log = logging.getLogger("waiter")
+
+class WaitTimeout(Exception):
+    """Raised when conditions pass their deadline without being met."""
+
+    def __init__(self, conditions):
+        Exception.__init__(self, "Timed out waiting for: %s" % ", ".join(c.name for c in conditions))
+        self.conditions = conditions
+
+class ConditionFailed(Exception):
+    """Raised by a condition that will never be met, to stop waiting for it."""
+
+class Condition(object):
+    """A condition registered with a `Waiter`."""
+
+    def __init__(self, func, on_met=None, on_timeout=None, deadline=None, name=None, on_fail=None):
+        self.func = func
+        self.on_met = on_met
+        self.on_timeout = on_timeout
+        self.on_fail = on_fail
+        self.deadline = deadline
+        self.name = name or getattr(func, "__name__", repr(func))
+        self.met = False
+        self.timed_out = False
+        self.cancelled = False
+        self.exc_info = None
+
+    @property
+    def failed(self):
+        return self.exc_info is not None
+
+    @property
+    def done(self):
+        return self.met or self.timed_out or self.cancelled or self.failed
+
+    def cancel(self):
+        """Stop waiting for this condition. Its callbacks won't be called."""
+
+        self.cancelled = True
+
+class Waiter(object):
+    """Polls a set of conditions until all of them are met, time out or
+    are cancelled.
+
+    The delay between polls starts at `base` seconds and doubles up to
+    `cap`, and each delay is scaled by a random factor within `jitter`
+    so that many waiters don't poll in lock step. Hooks added with
+    `add_hook` run once per poll before any condition is checked, which
+    is where batched refreshes (e.g. `instances.refresh`) belong."""
+
+    def __init__(self, base=0.25, cap=8, jitter=0.2):
+        self.base = base
+        self.cap = cap
+        self.jitter = jitter
+        self.conditions = []
+        self.hooks = []
+        self.cancelled = False
+        self._thread = None
+        self._exc_info = None
+
+    def add(self, func, on_met=None, on_timeout=None, timeout=None, name=None, on_fail=None):
+        """Waits for `func()` to return true. `on_met` is called with no
+        arguments as soon as it does. If `timeout` seconds pass first,
+        `on_timeout` is called, or `run` raises `WaitTimeout` if there is
+        no `on_timeout`. If `func` raises `ConditionFailed`, or `on_met`
+        raises, `on_fail` is called with the exception, or `run` raises
+        it if there is no `on_fail`. Returns the `Condition`."""
+
+        deadline = time.time() + timeout if timeout is not None else None
+        cond = Condition(func, on_met, on_timeout, deadline, name, on_fail)
+        self.conditions.append(cond)
+
+        return cond
+
+    def add_hook(self, func):
+        """Calls `func()` once per poll, before the conditions are checked."""
+
+        self.hooks.append(func)
+
+    def cancel(self):
+        """Stops the waiter; conditions that are still pending are cancelled."""
+
+        self.cancelled = True
+        [c.cancel() for c in self.conditions]
+
+    def pending(self):
+        return [c for c in self.conditions if not c.done]
+
+    def _fail(self, cond):
+        cond.exc_info = sys.exc_info()
+        log.error("Gave up waiting for %s: %s", cond.name, cond.exc_info[1])
+        if cond.on_fail is not None:
+            cond.on_fail(cond.exc_info[1])
+
+    def poll(self):
+        """Checks every pending condition once."""
+
+        for hook in self.hooks:
+            try:
+                hook()
+            except Exception, e:
+                log.warning("Waiter hook failed; retrying on the next poll: %s", e)
+
+        now = time.time()
+        for cond in self.pending():
+            try:
+                met = cond.func()
+            except ConditionFailed:
+                self._fail(cond)
+                continue
+            except Exception, e:
+                log.warning("Checking %s failed; retrying on the next poll: %s", cond.name, e)
+                met = False
+
+            if met:
+                cond.met = True
+                if cond.on_met is not None:
+                    try:
+                        cond.on_met()
+                    except Exception:
+                        self._fail(cond)
+            elif cond.deadline is not None and now >= cond.deadline:
+                cond.timed_out = True
+                log.warning("Timed out waiting for %s", cond.name)
+                if cond.on_timeout is not None:
+                    cond.on_timeout()
+
+    def delay(self, i):
+        """Returns the time to sleep after the `i`th poll."""
+
+        delay = min(self.cap, self.base * (2 ** min(i, 16)))
+        delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+
+        deadlines = [c.deadline for c in self.pending() if c.deadline is not None]
+        if deadlines:
+            delay = min(delay, max(0, min(deadlines) - time.time()))
+
+        return delay
+
+    def run(self):
+        """Polls until no conditions are pending. Then re-raises the error
+        of the first condition that failed without an `on_fail`
+        callback, if any, or raises `WaitTimeout` for conditions that
+        timed out without an `on_timeout` callback."""
+
+        with timeline.span("wait for %d conditions" % len(self.conditions), "wait",
+                           conditions=[c.name for c in self.conditions]):
+            i = 0
+            while not self.cancelled:
+                self.poll()
+
+                if not self.pending():
+                    break
+
+                time.sleep(self.delay(i))
+                i += 1
+
+        failed = [c for c in self.conditions if c.failed and c.on_fail is None]
+        if failed:
+            exc_info = failed[0].exc_info
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        timed_out = [c for c in self.conditions if c.timed_out and c.on_timeout is None]
+        if timed_out:
+            raise WaitTimeout(timed_out)
+
+    def start(self):
+        """Runs the waiter in a background thread. Use `join` to wait for it."""
+
+        def run():
+            try:
+                self.run()
+            except:
+                self._exc_info = sys.exc_info()
+
+        self._thread = threading.Thread(target=run, name="waiter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def join(self, timeout=None):
+        """Waits for a waiter started with `start` and re-raises its exception."""
+
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+        if self._exc_info is not None:
+            exc_info, self._exc_info = self._exc_info, None
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+def wait(func, timeout=None, **kwargs):
+    """Waits for `func()` to return true, raising `WaitTimeout` after
+    `timeout` seconds."""
+
+    waiter = Waiter(**kwargs)
+    waiter.add(func, timeout=timeout)
+    waiter.run()
@@ -0,0 +1,99 @@
+"""Builds the site's virtualenv from prebuilt wheels.
+
+The first host to need a set of requirements compiles them into a
+wheelhouse, which goes into the artifact cache under a hash of the
+requirements file, the Python version and the architecture. Every host
+after that installs from the wheelhouse with no index access, and the
+virtualenv it ends up with is cached too (made relocatable) so that
+later hosts can unpack it and skip pip altogether. start_instance
+carries the cache between the hosts that get the site, and when it
+launches several at once the first builds the wheelhouse for the rest;
+see artifacts."""
+
+import logging
+import os
+import os.path as opath
+import platform
+import shutil
+
+import artifacts
+import runcmd as rc
+
+log = logging.getLogger("wheelhouse")
+
+def requirements_key(requirements):
+    with open(requirements) as req_in:
+        contents = req_in.read()
+
+    return artifacts.artifact_key(requirements=contents, python=platform.python_version())
+
+def _cache_tree(cache, name, key, root):
+    """Tars the contents of `root` into `cache` as artifact `name`."""
+
+    if not opath.isdir(cache.root):
+        os.makedirs(cache.root)
+
+    fd, tar_path = rc.temp_file(dir=cache.root)
+    os.close(fd)
+    rc.run(["tar", "czf", tar_path, "-C", root, "."])
+
+    if not rc.backend().live:
+        os.remove(tar_path)
+        return None
+
+    return cache.put(name, key, tar_path)
+
+def _unpack(path, root):
+    if not opath.isdir(root):
+        os.makedirs(root)
+
+    rc.run(["tar", "xzf", path, "-C", root])
+
+def build(requirements, cache, key):
+    """Compiles `requirements` into a wheelhouse in `cache` and returns its path."""
+
+    work_dir = rc.temp_dir(prefix="wheelhouse-")
+    try:
+        build_venv = opath.join(work_dir, "venv")
+        wheel_dir = opath.join(work_dir, "wheels")
+        pip = opath.join(build_venv, "bin", "pip")
+
+        log.info("Building wheels for %s", requirements)
+        rc.run(["virtualenv", build_venv])
+        rc.run([pip, "install", "wheel"])
+        rc.run([pip, "wheel", "--wheel-dir", wheel_dir, "-r", requirements])
+
+        return _cache_tree(cache, "wheelhouse", key, wheel_dir)
+    finally:
+        shutil.rmtree(work_dir)
+
+def install(requirements, venv_dir, cache):
+    """Sets up the virtualenv at `venv_dir` with `requirements`,
+    unpacking a cached virtualenv if there is one, or else installing
+    from the wheelhouse (built first if need be) without an index."""
+
+    key = requirements_key(requirements)
+
+    venv = cache.get("venv", key)
+    if venv is not None and not opath.exists(venv_dir):
+        log.info("Unpacking cached virtualenv %s", venv)
+        _unpack(venv, venv_dir)
+        return
+
+    wheels = cache.get("wheelhouse", key) or build(requirements, cache, key)
+
+    wheel_dir = rc.temp_dir(prefix="wheels-")
+    try:
+        if wheels is not None:
+            _unpack(wheels, wheel_dir)
+
+        log.info("Installing %s into %s from the wheelhouse", requirements, venv_dir)
+        rc.run(["virtualenv", venv_dir])
+        rc.run([opath.join(venv_dir, "bin", "pip"), "install", "--no-index", "--find-links", wheel_dir,
+                "-r", requirements])
+    finally:
+        shutil.rmtree(wheel_dir)
+
+    if venv is None:
+        rc.run(["virtualenv", "--relocatable", venv_dir])
+        _cache_tree(cache, "venv", key, venv_dir)
@@ -4,12 +4,14 @@ setup(
     name = "aint",
     version = "0.1",
     packages = find_packages(),
-    install_requires = ["boto >= 2.3.0"],
+    install_requires = ["boto >= 2.18.0"],
     entry_points = {
         'console_scripts': [
             'start_instance = aint.start_instance:main',
             "setup_web_ami = aint.setup_web_ami:main",
             "sync_web_dns = aint.setup_web_ami:sync_web_dns",
+            "list_instances = aint.snapshot:main",
+            "bake_ami = aint.bake_ami:main",
         ],
     }
 )